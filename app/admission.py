@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+try:
+    from .errors import Overloaded
+    from .scheduler import Priority, PriorityScheduler
+except ImportError:
+    from errors import Overloaded
+    from scheduler import Priority, PriorityScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    同時実行数の上限と有界の待ち行列で処理の受け入れを制御する
+
+    schedulerを指定した場合は、待ち行列の処理を到着順ではなく優先度順（エージング付き）に実行枠へ割り当てる
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int,
+                 scheduler: Optional[PriorityScheduler] = None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.scheduler = scheduler
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._queued = 0
+        self._shed = 0
+
+    def _reject(self, reason: str):
+        self._shed += 1
+        logger.warning("%s: リクエストを拒否しました (%s)", self.name, reason)
+        raise Overloaded(f"サーバーが混雑しています。しばらくしてから再試行してください。({reason})", self.retry_after)
+
+    def limit_by(self, limit: Callable[[], int], long_audio_limit: Optional[Callable[[], int]] = None):
+        """依存サービスのリミッターの現在の上限を実行枠数に反映する（PriorityScheduler.bind_limits）"""
+        if self.scheduler is None:
+            raise ValueError(f"{self.name}: 優先度付きの隔壁のみリミッターと連動できます")
+        self.scheduler.bind_limits(limit, long_audio_limit)
+
+    def reject_if_saturated(self):
+        """実行枠も待ち行列も満杯ならOverloadedを送出する（処理枠は確保しない。重い前処理の前の早期拒否用）"""
+        if self._active >= self.max_concurrent and self._waiting >= self.max_queue:
+            self._reject("待ち行列が満杯")
+
+    async def _try_acquire(self, priority: Priority) -> bool:
+        """待たずに処理枠を取得できれば取得する"""
+        if self.scheduler is not None:
+            return self.scheduler.try_acquire(priority)
+        if self._semaphore.locked():
+            return False
+        # 空きがあるため待たずに取得できる
+        await self._semaphore.acquire()
+        return True
+
+    async def _wait(self, priority: Priority):
+        if self.scheduler is not None:
+            await self.scheduler.acquire(priority)
+        else:
+            await self._semaphore.acquire()
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE):
+        """処理枠を確保する。確保できない場合はOverloadedを送出（release()で返却すること）"""
+        if not await self._try_acquire(priority):
+            if self._waiting >= self.max_queue:
+                self._reject("待ち行列が満杯")
+            self._waiting += 1
+            self._queued += 1
+            try:
+                await asyncio.wait_for(self._wait(priority), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject("待ち時間が上限を超過")
+            finally:
+                self._waiting -= 1
+
+        self._admitted += 1
+        self._active += 1
+
+    def release(self, priority: Priority = Priority.INTERACTIVE):
+        self._active -= 1
+        if self.scheduler is not None:
+            self.scheduler.release(priority)
+        else:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self, priority: Priority = Priority.INTERACTIVE):
+        """処理枠を確保する。確保できない場合はOverloadedを送出"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        result = {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "waiting": self._waiting,
+            "admitted": self._admitted,
+            "queued": self._queued,
+            "shed": self._shed,
+        }
+        if self.scheduler is not None:
+            result["priorities"] = self.scheduler.stats()
+        return result
+
+
+# 音声パイプライン（STT→Dialogflow→TTS）用の受け入れ制御
+voice_admission = AdmissionController(
+    "voice_chat",
+    max_concurrent=int(os.environ.get("VOICE_MAX_CONCURRENCY", "8")),
+    max_queue=int(os.environ.get("VOICE_MAX_QUEUE", "16")),
+    queue_timeout=float(os.environ.get("VOICE_QUEUE_TIMEOUT", "5")),
+    retry_after=int(os.environ.get("VOICE_RETRY_AFTER", "2")),
+)
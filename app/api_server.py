@@ -1,91 +1,151 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
+from google.api_core.exceptions import DeadlineExceeded as RpcDeadlineExceeded
+import asyncio
 import base64
+import dataclasses
+import hashlib
+import json
 import os
+import re
+import secrets
 import sys
 import uuid
 import logging
 from typing import Optional
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
+# ログ設定（バックグラウンドスレッドで書き出す構造化ログ）
+try:
+    from .log_config import setup_logging, sample_body, flush_logging, RequestIdMiddleware
+except ImportError:
+    from log_config import setup_logging, sample_body, flush_logging, RequestIdMiddleware
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# 環境検出
-def detect_environment():
-    """実行環境を検出"""
-    is_docker = os.path.exists('/.dockerenv') or os.environ.get('DOCKER_ENV') == 'true'
-    is_cloud_run = os.environ.get('K_SERVICE') is not None
-    is_local = not (is_docker or is_cloud_run)
-    
-    logger.info(f"環境検出: Docker={is_docker}, CloudRun={is_cloud_run}, Local={is_local}")
-    return is_docker, is_cloud_run, is_local
-
 # 現在のディレクトリをPythonパスに追加
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.insert(0, current_dir)
 
-# 環境に応じたインポート切り替え
-def get_imports():
-    """環境に応じて適切なインポート方法を選択"""
-    is_docker, is_cloud_run, is_local = detect_environment()
-    
-    # 複数のインポート方法を試行
-    import_methods = []
-    
-    if is_docker or is_cloud_run:
-        # コンテナ環境: 絶対インポートを優先
-        import_methods.extend([
-            lambda: (__import__('dialogflow_client').detect_intent_texts,
-                    __import__('stt').transcribe_audio,
-                    __import__('tts').synthesize_speech),
-            lambda: (__import__('app.dialogflow_client').detect_intent_texts,
-                    __import__('app.stt').transcribe_audio,
-                    __import__('app.tts').synthesize_speech)
-        ])
-    else:
-        # ローカル環境: 相対インポートを優先
-        import_methods.extend([
-            lambda: (__import__('app.dialogflow_client').detect_intent_texts,
-                    __import__('app.stt').transcribe_audio,
-                    __import__('app.tts').synthesize_speech),
-            lambda: (__import__('dialogflow_client').detect_intent_texts,
-                    __import__('stt').transcribe_audio,
-                    __import__('tts').synthesize_speech)
-        ])
-    
-    # 各インポート方法を試行
-    for i, import_method in enumerate(import_methods):
-        try:
-            detect_intent_texts, transcribe_audio, synthesize_speech = import_method()
-            logger.info(f"インポート成功 (方法{i+1})")
-            return detect_intent_texts, transcribe_audio, synthesize_speech
-        except ImportError as e:
-            logger.warning(f"インポート方法{i+1}失敗: {e}")
-            continue
-    
-    # すべてのインポート方法が失敗した場合のフォールバック
-    logger.error("すべてのインポート方法が失敗しました。ダミー関数を使用します。")
-    
-    def dummy_detect_intent_texts(text: str, session_id: str):
-        return [f"エラー: Dialogflowに接続できません。入力: {text}"]
-    
-    def dummy_transcribe_audio(audio_content):
-        return "音声認識サービスに接続できません"
-    
-    def dummy_synthesize_speech(text):
-        return b"TTS service unavailable"
-    
-    return dummy_detect_intent_texts, dummy_transcribe_audio, dummy_synthesize_speech
+# 実行環境とバックエンドのインポート先を起動時に一度だけ解決する
+try:
+    from .runtime import resolve_runtime
+except ImportError:
+    from runtime import resolve_runtime
+PROFILE, _backends = resolve_runtime(__package__)
+detect_intent_texts = _backends.detect_intent_texts
+detect_intent_texts_async = _backends.detect_intent_texts_async
+speech_to_text = _backends.transcribe_audio
+streaming_recognize = _backends.streaming_recognize
+synthesize_speech = _backends.synthesize_speech
+SERVICE_STATUS = "available" if PROFILE.backends_available else "unavailable"
 
-# インポートを実行
-detect_intent_texts, speech_to_text, synthesize_speech = get_imports()
+# 依存サービスごとのワーカープール
+try:
+    from .executors import run_in_pool, pool_stats, shutdown_pools
+    from .channel_pool import channel_pool
+    from .admission import voice_admission
+    from .errors import Overloaded, PayloadTooLarge
+    from .deadline import Deadline, DeadlineExceeded
+    from .disconnect import PipelineProgress, cancel_on_disconnect, cancel_stats
+    from .sessions import session_sequencer
+    from .scheduler import Priority, classify_audio
+    from .limiter import limiter_stats
+    from .bulkhead import bulkheads, bulkhead_stats
+    from .lifecycle import DrainMiddleware, lifecycle
+    from .jobs import voice_jobs
+    from .clients import clients
+    from .idempotency import IDEMPOTENCY_HEADER, IdempotencyKeyMismatch, idempotency_store, request_fingerprint
+    from .singleflight import stt_flight, tts_flight, singleflight_stats
+    from .loop_monitor import loop_monitor
+    from .streaming import RecognizeStream
+    from . import voice_response
+    from .audio_store import audio_store
+    from .range_response import file_response
+    from .ingest import AudioIngest, ingest_budget, ingest_request
+    from .uploads import UPLOAD_PURGE_INTERVAL, UploadConflict, upload_store
+    from . import fork_safety  # noqa: F401  fork後にクライアント・チャネルを作り直す
+except ImportError:
+    from executors import run_in_pool, pool_stats, shutdown_pools
+    from channel_pool import channel_pool
+    from admission import voice_admission
+    from errors import Overloaded, PayloadTooLarge
+    from deadline import Deadline, DeadlineExceeded
+    from disconnect import PipelineProgress, cancel_on_disconnect, cancel_stats
+    from sessions import session_sequencer
+    from scheduler import Priority, classify_audio
+    from limiter import limiter_stats
+    from bulkhead import bulkheads, bulkhead_stats
+    from lifecycle import DrainMiddleware, lifecycle
+    from jobs import voice_jobs
+    from clients import clients
+    from idempotency import IDEMPOTENCY_HEADER, IdempotencyKeyMismatch, idempotency_store, request_fingerprint
+    from singleflight import stt_flight, tts_flight, singleflight_stats
+    from loop_monitor import loop_monitor
+    from streaming import RecognizeStream
+    import voice_response
+    from audio_store import audio_store
+    from range_response import file_response
+    from ingest import AudioIngest, ingest_budget, ingest_request
+    from uploads import UPLOAD_PURGE_INTERVAL, UploadConflict, upload_store
+    import fork_safety  # noqa: F401  fork後にクライアント・チャネルを作り直す
 
 app = FastAPI()
 
+# ドレイン中も応答する監視用エンドポイント
+DRAIN_EXEMPT_PATHS = {"/health", "/metrics"}
+
+# 診断用エンドポイント（スタックトレースを含む）のトークン。未設定の場合は無効
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN")
+
+# 純粋なASGIミドルウェアとして追加する（BaseHTTPMiddlewareはhttp.disconnectを伝えないため切断検出が効かなくなる）
+app.add_middleware(DrainMiddleware, lifecycle=lifecycle, exempt_paths=DRAIN_EXEMPT_PATHS)
+
+# 起動時ウォームアップの1回あたりのタイムアウトと再試行間隔（秒）
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "10"))
+WARMUP_RETRY_INTERVAL = float(os.environ.get("WARMUP_RETRY_INTERVAL", "5"))
+
+# リクエストごとの相関ID（ドレインより外側で設定し、拒否した応答にも付与する）
+app.add_middleware(RequestIdMiddleware)
+
+@app.on_event("startup")
+async def on_startup():
+    # SIGTERMを受けた時点で新規受付を止める
+    lifecycle.install_signal_handlers()
+    # 後始末は登録の逆順に実行されるため、ログの書き出しを最初に登録して最後に実行する
+    lifecycle.add_cleanup(flush_logging)
+    # gRPCクライアントを生成してチャネルを接続しておく（完了までは /ready が503）
+    if PROFILE.backends_available:
+        warmup_task = asyncio.get_running_loop().create_task(
+            clients.warmup_until_ready(WARMUP_TIMEOUT, WARMUP_RETRY_INTERVAL)
+        )
+        lifecycle.add_cleanup(warmup_task.cancel)
+    # イベントループの遅延とブロッキングを監視する
+    loop_monitor.start()
+    lifecycle.add_cleanup(loop_monitor.stop)
+    # 完了しなかったアップロードを新規作成がなくても削除する
+    purge_task = asyncio.get_running_loop().create_task(_purge_uploads_periodically())
+    lifecycle.add_cleanup(purge_task.cancel)
+    lifecycle.add_cleanup(voice_jobs.shutdown)
+    lifecycle.add_cleanup(shutdown_pools)
+    lifecycle.add_cleanup(channel_pool.close_all)
+
+async def _purge_uploads_periodically():
+    while True:
+        await asyncio.sleep(UPLOAD_PURGE_INTERVAL)
+        try:
+            await run_in_pool("audio", upload_store.purge_expired)
+        except Exception as e:
+            logger.warning("期限切れのアップロードの削除に失敗しました: %s", e)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # 処理中のパイプラインを猶予時間内で完了させてからチャネル・プールを解放する
+    await lifecycle.shutdown()
+
 # CORS設定 - 環境に応じて動的に設定
 def get_cors_origins():
     """環境に応じてCORS設定を動的に生成"""
@@ -105,7 +165,7 @@ def get_cors_origins():
     additional_origins = os.environ.get('CORS_ORIGINS', '').split(',')
     base_origins.extend([origin.strip() for origin in additional_origins if origin.strip()])
     
-    logger.info(f"CORS設定: {base_origins}")
+    logger.info("CORS設定: %s", base_origins)
     return base_origins
 
 app.add_middleware(
@@ -114,8 +174,82 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 音声をバイナリで返す場合のテキストをブラウザから読めるようにする
+    # 再開可能なアップロードのオフセットも同様
+    expose_headers=voice_response.EXPOSE_HEADERS + ["Upload-Offset", "Upload-Length", "Location"],
 )
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """飽和時は即座に503とRetry-Afterを返す"""
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(PayloadTooLarge)
+async def payload_too_large_handler(request: Request, exc: PayloadTooLarge):
+    """上限を超えたアップロードは残りの本文を受信せずに413を返す"""
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=413,
+        headers={"Connection": "close"}
+    )
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    """締め切りまでに応答を生成できない場合は504を返す"""
+    return JSONResponse(
+        content={"error": str(exc), "stage": exc.stage},
+        status_code=504
+    )
+
+# 共有した呼び出しが先行した呼び出し元のタイムアウト・優先度で失敗した場合、後から合流した呼び出し元は自身の条件でやり直す
+FLIGHT_RETRY_ON = (RpcDeadlineExceeded, Overloaded)
+
+# 締め切り付きで呼び出すための各ステージのラッパー（timeoutはDeadline.runが渡す）
+# 依存サービスごとの隔壁の枠を優先度順に取得する（待機中はテキストチャット→短い音声→長い音声の順、エージング付き）。
+# 隔壁の待ち行列が満杯の依存サービスは即座に失敗する
+async def _stt(audio_content: bytes, priority: Priority, timeout: float,
+               digest: Optional[str] = None, filename: Optional[str] = None):
+    async def call():
+        async with bulkheads["stt"].admit(priority):
+            return await run_in_pool("stt", speech_to_text, audio_content, filename, timeout=timeout)
+    # 同じ音声の認識が実行中であれば結果を共有する（受信時に計算したハッシュがあれば使う）
+    return await stt_flight.do(digest or hashlib.sha256(audio_content).hexdigest(), call, retry_on=FLIGHT_RETRY_ON)
+
+async def _dialogflow(text: str, session_id: str, priority: Priority, timeout: float):
+    async with bulkheads["dialogflow"].admit(priority):
+        return await detect_intent_texts_async(text, session_id, timeout=timeout)
+
+async def _tts(text: str, priority: Priority, timeout: float):
+    async def call():
+        async with bulkheads["tts"].admit(priority):
+            return await run_in_pool("tts", synthesize_speech, text, timeout=timeout)
+    # 同じテキスト（定型の応答など）の音声合成が実行中であれば結果を共有する
+    return await tts_flight.do(text, call, retry_on=FLIGHT_RETRY_ON)
+
+async def _idempotent(http_request: Request, fingerprint: str, handler):
+    """
+    Idempotency-Keyヘッダーがあれば、同じキーのリクエストの結果を再利用する
+
+    Args:
+        fingerprint: リクエストの内容のハッシュ（同じキーで内容が異なる場合は422）
+    """
+    key = http_request.headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return await handler()
+    return await idempotency_store.run(f"{http_request.url.path}:{key}", fingerprint, handler)
+
+@app.exception_handler(IdempotencyKeyMismatch)
+async def idempotency_key_mismatch_handler(request: Request, exc: IdempotencyKeyMismatch):
+    """同じIdempotency-Keyで内容の異なるリクエストは処理せずに422を返す"""
+    return JSONResponse(
+        content={"error": str(exc)},
+        status_code=422
+    )
+
 class ChatRequest(BaseModel):
     text: str
     session_id: Optional[str] = None
@@ -127,39 +261,136 @@ class VoiceChatResponse(BaseModel):
     error: Optional[str] = None
 
 @app.post("/text_chat")
-async def text_chat(request: ChatRequest):
-    logger.info(f"Received text chat request: {request}")
+async def text_chat(request: ChatRequest, http_request: Request):
+    logger.info("Received text chat request: %s", sample_body(request))
+    deadline = Deadline.from_headers(http_request.headers)
     
+    # 再送されたリクエストでDialogflowのセッションを二重に進めない
+    return await _idempotent(
+        http_request, request_fingerprint(request.text, request.session_id), lambda: _text_chat(request, deadline)
+    )
+
+async def _text_chat(request: ChatRequest, deadline: Deadline):
     try:
         # セッションIDの処理
         session_id = request.session_id if request.session_id else str(uuid.uuid4())
-        logger.info(f"Using session_id: {session_id}")
+        logger.info("Using session_id: %s", session_id)
         
-        # Dialogflow CXで応答を取得（元の関数シグネチャ）
-        response_messages = detect_intent_texts(request.text, session_id)
+        # Dialogflow CXで応答を取得（同一セッションのターンは到着順に直列化）
+        async with session_sequencer.turn(session_id):
+            response_messages = await deadline.run("dialogflow", _dialogflow, request.text, session_id, Priority.INTERACTIVE)
         
         # レスポンステキストを結合
         response_text = " ".join(response_messages) if response_messages else "すみません、応答を生成できませんでした。"
         
-        logger.info(f"Response: {response_text}")
+        logger.info("Response: %s", sample_body(response_text))
         
         return JSONResponse(content={
             "response": response_text, 
             "session_id": session_id
         })
         
+    except (DeadlineExceeded, Overloaded):
+        raise
     except Exception as e:
-        logger.error(f"Error in text_chat: {e}")
+        logger.error("Error in text_chat: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/voice_chat")
-async def voice_chat(file: UploadFile = File(...)):
-    logger.info(f"Received voice chat request: {file.filename}, size: {file.size}")
+# 音声のアップロードを受け付けるエンドポイントのリクエスト本文（本文は受信しながら取り込むためOpenAPIにのみ記載する）
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+async def _ingest(http_request: Request) -> AudioIngest:
+    """アップロードを受信しながら取り込む（上限を超えた時点でPayloadTooLarge）"""
+    try:
+        upload = await ingest_request(http_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info("Received audio upload: %s", upload.stats())
+    return upload
+
+@app.post("/voice_chat", openapi_extra=UPLOAD_OPENAPI)
+async def voice_chat(http_request: Request):
+    logger.info("Received voice chat request: content-length=%s", http_request.headers.get("content-length"))
+    # 待ち行列まで満杯なら音声を読み込む前に拒否する
+    voice_admission.reject_if_saturated()
+    # 再送が同じ音声かを確認するため、処理済みの結果を返す場合も本文は取り込む
+    upload = await _ingest(http_request)
+
+    async def load_upload() -> AudioIngest:
+        return upload
+
+    try:
+        return await _voice_turn(http_request, load_upload, request_fingerprint(upload.sha256))
+    finally:
+        upload.close()
+
+async def _voice_turn(http_request: Request, load_upload, fingerprint: str):
+    """
+    音声チャットの1ターンを実行する（/voice_chat と再開可能なアップロードの完了で共通）
+
+    Args:
+        load_upload: 取り込んだ音声（AudioIngest）を返す非同期関数
+        fingerprint: Idempotency-Keyに対応付けるリクエストの内容のハッシュ
+    """
+    response_mode = voice_response.negotiate(http_request.headers.get("accept"))
+    # ?audio=url の場合はbase64の音声を含めず、/audio/{id} のURLのみ返す
+    inline_audio = http_request.query_params.get("audio") != "url"
+    
+    async def run():
+        # 待ち行列まで満杯なら音声を読み込む前に拒否する
+        voice_admission.reject_if_saturated()
+        # 遅い回線のアップロードがパイプラインの処理枠を占有しないよう、枠を確保する前に取り込む
+        # （切断の監視も本文を読み終えてから始め、監視と取り込みが同じ受信ストリームを読まないようにする）
+        upload = await load_upload()
+        try:
+            # 締め切りはアップロードの受信時間を含めず、取り込み後から数える
+            deadline = Deadline.from_headers(http_request.headers)
+            async with voice_admission.admit():
+                # クライアントが切断したら残りのSTT・Dialogflow・TTSをキャンセルする
+                progress = PipelineProgress(("stt", "dialogflow", "tts"))
+                disconnected, response = await cancel_on_disconnect(
+                    http_request, _voice_pipeline(upload, deadline, progress, response_mode, inline_audio), progress
+                )
+        finally:
+            upload.close()
+        if disconnected:
+            return Response(status_code=499)
+        return response
     
+    # 再送されたリクエストではパイプラインを再実行せず、元の結果を返す
+    return await _idempotent(http_request, fingerprint, run)
+
+async def _read_upload(upload: AudioIngest) -> bytes:
+    """取り込んだ音声を読み込む（ディスクに退避している場合はスレッドプールで読む）"""
+    if upload.spooled:
+        return await run_in_pool("audio", upload.read)
+    return upload.read()
+
+async def _voice_pipeline(
+    upload: AudioIngest, deadline: Deadline, progress: PipelineProgress, response_mode: str, inline_audio: bool
+):
+    """音声認識→Dialogflow CX→音声合成のパイプライン（各ステージに残り時間を割り当てる）"""
     try:
         # 音声認識
-        audio_content = await file.read()
-        transcript = speech_to_text(audio_content)
+        audio_content = await _read_upload(upload)
+        progress.start("stt")
+        transcript = await deadline.run("stt", _stt, audio_content, classify_audio(len(audio_content)),
+            digest=upload.sha256, filename=upload.audio_filename()
+        )
+        progress.mark("stt")
 
         if not transcript or transcript.startswith("音声認識中にエラーが発生しました"):
             return JSONResponse(
@@ -171,53 +402,526 @@ async def voice_chat(file: UploadFile = File(...)):
         session_id = str(uuid.uuid4())
         
         # Dialogflow CXで応答を生成（元の関数シグネチャ）
-        response_messages = detect_intent_texts(transcript, session_id)
+        progress.start("dialogflow")
+        response_messages = await deadline.run("dialogflow", _dialogflow, transcript, session_id, Priority.SHORT_VOICE)
+        progress.mark("dialogflow")
         response_text = " ".join(response_messages) if response_messages else "すみません、応答を生成できませんでした。"
 
-        # 音声合成
+        # 音声合成（時間が残っていなければテキストのみ返す）
         try:
-            audio_response = synthesize_speech(response_text)
-            audio_base64 = base64.b64encode(audio_response).decode("utf-8")
+            progress.start("tts")
+            audio_response = await deadline.run("tts", _tts, response_text, Priority.SHORT_VOICE)
+            progress.mark("tts")
+        except DeadlineExceeded:
+            logger.warning("締め切りまでの残り時間が不足しているためTTSをスキップ: 残り%.2f秒", deadline.remaining())
+            audio_response = None
         except Exception as tts_error:
-            logger.warning(f"TTS error: {tts_error}")
-            audio_base64 = None
+            logger.warning("TTS error: %s", tts_error)
+            audio_response = None
 
-        return JSONResponse(content={
-            "transcript": transcript,
-            "response": response_text,
-            "audio_base64": audio_base64,
-            "session_id": session_id
-        })
+        # 再生し直し・途中からの再開に使えるよう音声ストアに保存する
+        audio_url = None
+        if audio_response is not None:
+            try:
+                audio_id = await run_in_pool("audio", audio_store.put, audio_response)
+                audio_url = f"/audio/{audio_id}"
+            except OSError as store_error:
+                logger.warning("音声ストアへの保存に失敗: %s", store_error)
+
+        # Acceptヘッダーに応じて音声をバイナリ（audio/mpeg・multipart）またはbase64のJSONで返す
+        return voice_response.render(
+            response_mode, transcript, response_text, session_id, audio_response,
+            audio_url=audio_url, inline_audio=inline_audio or audio_url is None
+        )
         
+    except (DeadlineExceeded, Overloaded):
+        raise
     except Exception as e:
-        logger.error(f"Error in voice_chat: {e}")
+        logger.error("Error in voice_chat: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+# 音声合成を分割する文の区切り（句点・感嘆符・疑問符・改行）
+SENTENCE_DELIMITER = re.compile(r"(?<=[。！？!?\n])")
+
+def _split_sentences(text: str, min_chars: int = 20) -> list[str]:
+    """応答テキストを音声合成の単位に分割する（短すぎる文は次の文とまとめる）"""
+    chunks, current = [], ""
+    for sentence in SENTENCE_DELIMITER.split(text):
+        current += sentence
+        if len(current.strip()) >= min_chars:
+            chunks.append(current.strip())
+            current = ""
+    if current.strip():
+        chunks.append(current.strip())
+    return chunks
+
+def _event(event_type: str, **fields) -> dict:
+    return {"type": event_type, **fields}
+
+def _ndjson(event: dict) -> bytes:
+    return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+@app.post("/voice_chat/stream", openapi_extra=UPLOAD_OPENAPI)
+async def voice_chat_stream(http_request: Request):
+    """
+    /voice_chat のストリーミング版（NDJSON）
+
+    各ステージが完了した時点でイベントを送る:
+    accepted → transcript → response → audio（文ごと）→ done（失敗時は error）
+    """
+    logger.info("Received voice chat stream request: content-length=%s", http_request.headers.get("content-length"))
+    
+    # 飽和時・上限超過時はストリームを開始する前に503・413を返す
+    # （アップロードの受信中はパイプラインの処理枠を占有しない）
+    voice_admission.reject_if_saturated()
+    upload = await _ingest(http_request)
+    deadline = Deadline.from_headers(http_request.headers)
+    try:
+        await voice_admission.acquire()
+    except BaseException:
+        upload.close()
+        raise
+    events = _voice_stream_events(upload, deadline)
+    try:
+        # ジェネレーターを開始しておき、以降は必ずfinallyで処理枠の返却と一時ファイルの削除が行われるようにする
+        first = await events.__anext__()
+    except BaseException:
+        upload.close()
+        voice_admission.release()
+        raise
+
+    async def body():
+        yield first
+        async for chunk in events:
+            yield chunk
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+async def _voice_stream_events(upload: AudioIngest, deadline: Deadline):
+    """ストリーミング版の音声パイプライン（クライアント切断時はStreamingResponseがキャンセルする）"""
+    session_id = str(uuid.uuid4())
+    try:
+        yield _ndjson(_event("accepted", session_id=session_id))
+
+        audio_content = await _read_upload(upload)
+        transcript = await deadline.run("stt", _stt, audio_content, classify_audio(len(audio_content)),
+            digest=upload.sha256, filename=upload.audio_filename()
+        )
+        if not transcript or transcript.startswith("音声認識中にエラーが発生しました"):
+            yield _ndjson(_event("error", error="音声を認識できませんでした"))
+            return
+        yield _ndjson(_event("transcript", transcript=transcript, session_id=session_id))
+
+        async for event in _reply_events(transcript, session_id, deadline):
+            yield _ndjson(event)
+
+        yield _ndjson(_event("done", session_id=session_id))
+    except (DeadlineExceeded, Overloaded) as e:
+        yield _ndjson(_event("error", error=str(e)))
+    except Exception as e:
+        logger.error("Error in voice_chat_stream: %s", e)
+        yield _ndjson(_event("error", error=str(e)))
+    finally:
+        upload.close()
+        voice_admission.release()
+
+# 送信中の文に加えて先行して音声合成する文の数
+STREAM_TTS_LOOKAHEAD = max(0, int(os.environ.get("STREAM_TTS_LOOKAHEAD", "1")))
+
+async def _reply_events(transcript: str, session_id: str, deadline: Deadline):
+    """認識結果からDialogflowの応答と文ごとの合成音声のイベントを順に生成する"""
+    response_messages = await deadline.run("dialogflow", _dialogflow, transcript, session_id, Priority.SHORT_VOICE)
+    response_text = " ".join(response_messages) if response_messages else "すみません、応答を生成できませんでした。"
+    yield _event("response", response=response_text, session_id=session_id)
+
+    # 送信中の文の先の数文だけ音声合成を先行して開始し、完了した順ではなく文の順に送る
+    # （長い応答でも1リクエストがTTSの隔壁を占有しないようにする）
+    chunks = _split_sentences(response_text)
+    tasks = {}
+
+    def start_tts(index: int):
+        if index < len(chunks) and index not in tasks:
+            tasks[index] = asyncio.ensure_future(deadline.run("tts", _tts, chunks[index], Priority.SHORT_VOICE))
+
+    try:
+        for index, chunk in enumerate(chunks):
+            for ahead in range(index, index + STREAM_TTS_LOOKAHEAD + 1):
+                start_tts(ahead)
+            try:
+                audio = await tasks.pop(index)
+            except DeadlineExceeded:
+                logger.warning("締め切りまでの残り時間が不足しているため残りのTTSをスキップ: %d/%d", index, len(chunks))
+                yield _event("audio_skipped", index=index, reason="deadline")
+                break
+            except Exception as tts_error:
+                logger.warning("TTS error: %s", tts_error)
+                yield _event("audio_skipped", index=index, reason=str(tts_error))
+                break
+            yield _event(
+                "audio",
+                index=index,
+                text=chunk,
+                audio_base64=base64.b64encode(audio).decode("utf-8"),
+                last=index == len(chunks) - 1
+            )
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+# 1発話あたりのストリーミング認識の上限時間（秒）。Speech APIのストリームの上限（約5分）より短くする
+WS_MAX_UTTERANCE_SECONDS = float(os.environ.get("WS_MAX_UTTERANCE_SECONDS", "60"))
+# WebSocketで受け付ける音声形式（format → 形式判定に使うファイル名）
+WS_AUDIO_FORMATS = {"webm": "audio.webm", "ogg": "audio.ogg", "wav": "audio.wav"}
+
+@app.websocket("/ws/voice")
+async def voice_ws(websocket: WebSocket):
+    """
+    全二重の音声セッション（話している途中から音声認識を進める）
+
+    クライアント → サーバー:
+        {"type": "start", "format": "webm"}  発話の開始（発話ごとに新しい録音を始める）
+        バイナリフレーム                     音声チャンク
+        {"type": "stop"}                     発話の終了（無音検出による自動終了も可）
+    サーバー → クライアント:
+        ready → interim（認識途中）→ transcript（確定）→ response → audio（文ごと）→ done、失敗時は error
+    """
+    if lifecycle.draining:
+        # 1013: Try Again Later
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+    lifecycle.request_started()
+
+    session_id = websocket.query_params.get("session_id") or str(uuid.uuid4())
+    send_lock = asyncio.Lock()
+    stream: Optional[RecognizeStream] = None
+    turns: set[asyncio.Task] = set()
+
+    async def send(event: dict):
+        # 認識結果と応答を別タスクから送るため、フレームの送信を直列化する
+        async with send_lock:
+            await websocket.send_text(json.dumps(event, ensure_ascii=False))
+
+    async def utterance(current: RecognizeStream):
+        """1発話分の認識結果を中継し、確定した時点でDialogflowと音声合成を開始する"""
+        try:
+            async with bulkheads["stt_stream"].admit():
+                current.start()
+                transcript = None
+                async for text, is_final in current.results():
+                    if is_final:
+                        transcript = text
+                        break
+                    await send(_event("interim", transcript=text))
+                # 確定後に届いた音声は認識に使わない
+                await current.wait_closed()
+            if not transcript:
+                await send(_event("error", error="音声を認識できませんでした"))
+                return
+            await send(_event("transcript", transcript=transcript, session_id=session_id))
+
+            deadline = Deadline.from_headers(websocket.headers)
+            # 同一セッションのターンは到着順に直列化する（前の応答の途中で次の発話が確定した場合）
+            async with session_sequencer.turn(session_id):
+                async for event in _reply_events(transcript, session_id, deadline):
+                    await send(event)
+            await send(_event("done", session_id=session_id))
+        except (DeadlineExceeded, Overloaded) as e:
+            await send(_event("error", error=str(e)))
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error("Error in voice_ws: %s", e)
+            await send(_event("error", error=str(e)))
+        finally:
+            current.close()
+
+    try:
+        await send(_event("ready", session_id=session_id))
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if stream is not None:
+                    stream.feed(message["bytes"])
+                continue
+
+            try:
+                command = json.loads(message.get("text") or "")
+            except ValueError:
+                await send(_event("error", error="不正なメッセージです"))
+                continue
+            if command.get("type") == "start":
+                if stream is not None:
+                    stream.close()
+                filename = WS_AUDIO_FORMATS.get(command.get("format", "webm"), "audio.webm")
+                stream = RecognizeStream(streaming_recognize, filename=filename, timeout=WS_MAX_UTTERANCE_SECONDS)
+                task = asyncio.create_task(utterance(stream))
+                turns.add(task)
+                task.add_done_callback(turns.discard)
+            elif command.get("type") == "stop":
+                if stream is not None:
+                    stream.close()
+                    stream = None
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # 切断されたら認識を終了し、実行中のDialogflow・音声合成をキャンセルする
+        if stream is not None:
+            stream.close()
+        for task in list(turns):
+            task.cancel()
+        lifecycle.request_finished()
+
+# 再開可能なアップロード（長い録音をチャンクに分けて送り、切断されても続きから再送する）
+UPLOAD_OFFSET_HEADER = "Upload-Offset"
+UPLOAD_LENGTH_HEADER = "Upload-Length"
+
+def _upload_headers(upload: dict) -> dict:
+    headers = {UPLOAD_OFFSET_HEADER: str(upload["offset"]), "Cache-Control": "no-store"}
+    if upload.get("length") is not None:
+        headers[UPLOAD_LENGTH_HEADER] = str(upload["length"])
+    return headers
+
+async def _get_upload(upload_id: str) -> dict:
+    upload = await run_in_pool("audio", upload_store.get, upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="アップロードが見つかりません")
+    return upload
+
+@app.exception_handler(UploadConflict)
+async def upload_conflict_handler(request: Request, exc: UploadConflict):
+    """オフセットの不一致は409と受信済みのオフセットを返す（クライアントはそこから再送する）"""
+    return JSONResponse(
+        content={"error": str(exc), "offset": exc.offset},
+        status_code=409,
+        headers={UPLOAD_OFFSET_HEADER: str(exc.offset)}
+    )
+
+@app.post("/uploads", status_code=201)
+async def create_upload(http_request: Request):
+    """
+    アップロードを作成する
+
+    Upload-Lengthヘッダーで全体のバイト数、X-Filenameヘッダーでファイル名（形式判定に使用）を指定できる
+    """
+    length = http_request.headers.get(UPLOAD_LENGTH_HEADER)
+    if length is not None and not length.isdigit():
+        raise HTTPException(status_code=400, detail=f"{UPLOAD_LENGTH_HEADER} が不正です")
+    upload = await run_in_pool(
+        "audio", upload_store.create, http_request.headers.get("x-filename"), int(length) if length else None
+    )
+    location = f"/uploads/{upload['upload_id']}"
+    return JSONResponse(
+        content={"upload_id": upload["upload_id"], "offset": 0, "upload_url": location},
+        status_code=201,
+        headers={**_upload_headers(upload), "Location": location}
+    )
+
+@app.api_route("/uploads/{upload_id}", methods=["GET", "HEAD"])
+async def get_upload_offset(upload_id: str):
+    """受信済みのオフセットを返す（再送の開始位置）"""
+    upload = await _get_upload(upload_id)
+    return JSONResponse(
+        content={"upload_id": upload["upload_id"], "offset": upload["offset"], "length": upload.get("length")},
+        headers=_upload_headers(upload)
+    )
+
+@app.put("/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, http_request: Request):
+    """
+    チャンクを追記する
+
+    Upload-Offsetヘッダーは受信済みのオフセットと一致する必要がある（一致しない場合は409）。
+    途中で切断された場合も受信できた分までは保持される
+    """
+    upload = await _get_upload(upload_id)
+    offset = http_request.headers.get(UPLOAD_OFFSET_HEADER)
+    if offset is None or not offset.isdigit():
+        raise HTTPException(status_code=400, detail=f"{UPLOAD_OFFSET_HEADER} ヘッダーが必要です")
+
+    with upload_store.writer(upload, int(offset)) as writer:
+        try:
+            async for chunk in http_request.stream():
+                if chunk:
+                    await run_in_pool("audio", writer.write, chunk)
+        except ClientDisconnect:
+            # 書き込めた分までは保持しており、クライアントはHEADでオフセットを確認して再送する
+            logger.info("チャンクの受信中に切断されました: %s (受信済み %d bytes)", upload_id, writer.offset)
+            return Response(status_code=499)
+        upload["offset"] = writer.offset
+    return Response(status_code=204, headers=_upload_headers(upload))
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def delete_upload(upload_id: str):
+    upload = await _get_upload(upload_id)
+    await run_in_pool("audio", upload_store.delete, upload["upload_id"])
+    return Response(status_code=204)
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, http_request: Request):
+    """
+    アップロードを完了し、音声チャットの1ターン（?target=voice、既定）または音声ジョブ（?target=job）として処理する
+
+    音声チャットの応答は /voice_chat と同じ（Accept・?audio=url・Idempotency-Keyに対応）
+    """
+    target = http_request.query_params.get("target", "voice")
+    if target not in ("voice", "job"):
+        raise HTTPException(status_code=400, detail="target は voice または job を指定してください")
+    try:
+        upload_id = str(uuid.UUID(upload_id))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="アップロードが見つかりません")
+
+    async def load_upload() -> AudioIngest:
+        upload = await _get_upload(upload_id)
+        if upload.get("length") is not None and upload["offset"] != upload["length"]:
+            raise UploadConflict(f"アップロードが完了していません（受信済み {upload['offset']} bytes）", upload["offset"])
+        ingest = await run_in_pool("audio", upload_store.ingest, upload)
+        logger.info("Finalized resumable upload: %s", ingest.stats())
+        return ingest
+
+    if target == "job":
+        ingest = await load_upload()
+        try:
+            job = await run_in_pool("jobs", voice_jobs.submit, ingest, ingest.audio_filename())
+        finally:
+            ingest.close()
+        await run_in_pool("audio", upload_store.delete, upload_id)
+        return JSONResponse(
+            content={"job_id": job["job_id"], "status": job["status"], "status_url": f"/voice_jobs/{job['job_id']}"},
+            status_code=202
+        )
+
+    # 完了後はアップロードを削除するため、応答を受け取れなかった場合に備えてIdempotency-Keyを付けて送ること
+    # （同じキーの再送にはアップロードを読み直さずに保持している結果を返す）
+    # アップロードのIDはキーの名前空間（パス）に含まれる
+    response = await _voice_turn(http_request, load_upload, request_fingerprint(upload_id))
+    if 200 <= response.status_code < 300:
+        await run_in_pool("audio", upload_store.delete, upload_id)
+    return response
+
+# 音声ストアの音声は内容のハッシュをIDとし変更されないため、長期間キャッシュさせる
+AUDIO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@app.api_route("/audio/{audio_id}", methods=["GET", "HEAD"])
+async def get_audio(audio_id: str, http_request: Request):
+    """音声ストアの合成音声を返す（ETagによる条件付きリクエストとRangeリクエストに対応）"""
+    path = audio_store.path(audio_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="音声が見つかりません")
+    try:
+        response = await run_in_pool(
+            "audio", file_response, http_request, path, f'"{audio_id}"', "audio/mpeg", AUDIO_CACHE_CONTROL
+        )
+    except FileNotFoundError:
+        # 容量の上限により削除された
+        raise HTTPException(status_code=404, detail="音声が見つかりません")
+    await run_in_pool("audio", audio_store.touch, audio_id)
+    return response
+
+@app.post("/voice_jobs", status_code=202, openapi_extra=UPLOAD_OPENAPI)
+async def create_voice_job(http_request: Request):
+    """音声ジョブを登録し、ジョブIDを即座に返す（処理はワーカープロセスで実行）"""
+    upload = await _ingest(http_request)
+    try:
+        # 退避した一時ファイルからジョブの入力ファイルへコピーする（メモリに全体を読み込まない）
+        job = await run_in_pool("jobs", voice_jobs.submit, upload, upload.audio_filename())
+    finally:
+        upload.close()
+    return JSONResponse(
+        content={
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "status_url": f"/voice_jobs/{job['job_id']}"
+        },
+        status_code=202
+    )
+
+@app.get("/voice_jobs/{job_id}")
+async def get_voice_job(job_id: str):
+    """音声ジョブの進捗と結果を返す"""
+    job = await run_in_pool("jobs", voice_jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "result": job["result"],
+        "error": job["error"]
+    }
+
 @app.get("/health")
 async def health_check():
     """ヘルスチェック用エンドポイント"""
-    is_docker, is_cloud_run, is_local = detect_environment()
     return {
-        "status": "healthy",
-        "environment": {
-            "docker": is_docker,
-            "cloud_run": is_cloud_run,
-            "local": is_local
-        },
+        "status": "draining" if lifecycle.draining else "healthy",
+        "environment": PROFILE.environment(),
         "services": {
-            "dialogflow": "available",
-            "stt": "available", 
-            "tts": "available"
+            "dialogflow": SERVICE_STATUS,
+            "stt": SERVICE_STATUS, 
+            "tts": SERVICE_STATUS
         }
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """ウォームアップが完了し、トラフィックを受けられる状態かを返す"""
+    readiness = clients.readiness()
+    ready = PROFILE.backends_available and readiness["ready"]
+    return JSONResponse(
+        content={"ready": ready, "clients": readiness["clients"]},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """ワーカープールとgRPCチャネルプールの状態"""
+    return {
+        "runtime": dataclasses.asdict(PROFILE),
+        "executors": pool_stats(),
+        "channels": channel_pool.stats(),
+        "admission": {
+            "voice_chat": voice_admission.stats()
+        },
+        "upload_ingest": ingest_budget.stats(),
+        "client_disconnects": cancel_stats,
+        "sessions": session_sequencer.stats(),
+        "limiters": limiter_stats(),
+        "bulkheads": bulkhead_stats(),
+        "voice_jobs": voice_jobs.stats(),
+        "audio_store": audio_store.stats(),
+        "idempotency": idempotency_store.stats(),
+        "singleflight": singleflight_stats(),
+        "event_loop_lag": loop_monitor.histogram()
+    }
+
+def _require_debug_token(http_request: Request):
+    """DEBUG_TOKENが未設定なら404、Authorization: Bearer のトークンが一致しなければ401"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = http_request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.strip().encode(), DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="診断用のトークンが必要です", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/debug/event_loop")
+async def debug_event_loop(http_request: Request):
+    """イベントループ遅延のヒストグラムと、ブロッキング検出時のスタック（DEBUG_TOKENが必要）"""
+    _require_debug_token(http_request)
+    return {
+        "interval_ms": loop_monitor.interval * 1000,
+        "block_threshold_ms": loop_monitor.threshold * 1000,
+        "lag": loop_monitor.histogram(),
+        "blocked": loop_monitor.blocked_stacks()
+    }
+
 @app.get("/")
 async def root():
     """ルートエンドポイント"""
-    is_docker, is_cloud_run, is_local = detect_environment()
-    env_name = "Cloud Run" if is_cloud_run else "Docker" if is_docker else "Local"
     return {
         "message": "Rap Agent Backend API",
-        "environment": env_name,
+        "environment": PROFILE.env_name,
         "version": "1.0.0"
     }
\ No newline at end of file
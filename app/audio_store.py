@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 合成音声の保存先と容量の上限（超えた場合は最も長く使われていない音声から削除する）
+AUDIO_STORE_DIR = os.environ.get("AUDIO_STORE_DIR", "/tmp/audio_store")
+AUDIO_STORE_MAX_BYTES = int(os.environ.get("AUDIO_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 削除時はこの割合まで減らし、保存のたびに削除が走らないようにする
+AUDIO_STORE_LOW_WATERMARK = 0.9
+# 他のワーカーの保存分を含めて使用量を数え直す間隔（秒）と、保存のたびに数え直す使用量の割合
+# （自プロセスの保存分しか数えていないため、ワーカー数倍まで増えないようにする）
+AUDIO_STORE_RESCAN_INTERVAL = 30
+AUDIO_STORE_RESCAN_FRACTION = 0.5
+# 最終利用時刻（mtime）を更新する最小間隔（秒）。Rangeリクエストのたびに書き込まない
+TOUCH_INTERVAL = 60
+
+AUDIO_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AudioStore:
+    """
+    合成音声を内容のハッシュ（SHA-256）をIDとしてローカルディスクに保存するストア
+
+    同じ内容は同じIDになるため、ファイルは作成後に変更されない（強いETag・長期キャッシュが使える）。
+    ワーカープロセス間でディレクトリを共有し、LRUの順序はファイルのmtimeで判定する。
+    他のワーカーの保存分も含めるため、使用量は定期的に（容量の半分を超えた後は保存のたびに）ディレクトリから数え直す。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._usage: Optional[int] = None
+        self._scanned_at = 0.0
+        self._stored = 0
+        self._deduplicated = 0
+        self._evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, audio_id: str) -> Optional[str]:
+        """音声ファイルのパス（IDが不正な場合はNone、パス操作を防ぐ）"""
+        if not AUDIO_ID_PATTERN.match(audio_id):
+            return None
+        return os.path.join(self.directory, f"{audio_id}.mp3")
+
+    def put(self, audio: bytes) -> str:
+        """音声を保存してIDを返す（既に同じ内容があれば書き込まない）"""
+        audio_id = hashlib.sha256(audio).hexdigest()
+        path = self.path(audio_id)
+        if os.path.exists(path):
+            self.touch(audio_id)
+            with self._lock:
+                self._deduplicated += 1
+            return audio_id
+
+        # 読み取り側が書きかけのファイルを読まないように置き換えで書き込む
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._stored += 1
+            if self._usage is not None:
+                self._usage += len(audio)
+            rescan = (
+                self._usage is None
+                or self._usage > self.max_bytes * AUDIO_STORE_RESCAN_FRACTION
+                or time.monotonic() - self._scanned_at >= AUDIO_STORE_RESCAN_INTERVAL
+            )
+        if rescan:
+            self._evict()
+        return audio_id
+
+    def touch(self, audio_id: str):
+        """最終利用時刻を更新する（LRUの判定に使う）"""
+        path = self.path(audio_id)
+        try:
+            if time.time() - os.stat(path).st_mtime >= TOUCH_INTERVAL:
+                os.utime(path)
+        except (OSError, TypeError):
+            pass
+
+    def _evict(self):
+        """容量を超えていれば最終利用時刻が古い順に削除する（他のワーカーが保存した分も含めて数え直す）"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".mp3"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            usage = sum(size for _, size, _ in entries)
+            if usage > self.max_bytes:
+                target = self.max_bytes * AUDIO_STORE_LOW_WATERMARK
+                for _, size, path in sorted(entries):
+                    if usage <= target:
+                        break
+                    try:
+                        # 配信中のファイルは開いているディスクリプタから最後まで読める
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    usage -= size
+                    self._evicted += 1
+                logger.info("音声ストアの容量超過のため削除しました: 使用量 %d bytes", usage)
+            self._usage = usage
+            self._scanned_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "usage_bytes": self._usage,
+                "stored": self._stored,
+                "deduplicated": self._deduplicated,
+                "evicted": self._evicted,
+            }
+
+
+audio_store = AudioStore(AUDIO_STORE_DIR, AUDIO_STORE_MAX_BYTES)
@@ -0,0 +1,48 @@
+import os
+from typing import Optional
+
+try:
+    from .admission import AdmissionController
+    from .executors import pools
+    from .scheduler import LONG_AUDIO_MAX_CONCURRENCY, PRIORITY_AGING_SECONDS, PriorityScheduler
+except ImportError:
+    from admission import AdmissionController
+    from executors import pools
+    from scheduler import LONG_AUDIO_MAX_CONCURRENCY, PRIORITY_AGING_SECONDS, PriorityScheduler
+
+# 隔壁が満杯のときに待てる最大時間（秒）。超えた場合は即座に失敗させる
+BULKHEAD_QUEUE_TIMEOUT = float(os.environ.get("BULKHEAD_QUEUE_TIMEOUT", "1"))
+
+
+def _bulkhead(name: str, size: int, prioritized: bool = True, long_audio_max: Optional[int] = None) -> AdmissionController:
+    prefix = name.upper()
+    max_concurrent = int(os.environ.get(f"{prefix}_BULKHEAD_SIZE", str(size)))
+    # 待ちが発生するのは隔壁なので、待機中の処理はここで優先度順に枠へ割り当てる
+    scheduler = None
+    if prioritized:
+        long_audio_max = max_concurrent if long_audio_max is None else long_audio_max
+        scheduler = PriorityScheduler(max_concurrent, long_audio_max, PRIORITY_AGING_SECONDS)
+    return AdmissionController(
+        name,
+        max_concurrent=max_concurrent,
+        max_queue=int(os.environ.get(f"{prefix}_BULKHEAD_QUEUE", "4")),
+        queue_timeout=BULKHEAD_QUEUE_TIMEOUT,
+        retry_after=1,
+        scheduler=scheduler,
+    )
+
+
+# 依存サービスごとの容量の隔壁（バルクヘッド）
+# TTSやSTTが遅延しても、その依存サービスの枠だけが埋まり他の処理の枠は奪われない。
+# STT/TTSの枠はスレッドプールのサイズと揃える（プールの待ち行列では到着順になるため、プールに入る前に順序を決める）
+bulkheads = {
+    "stt": _bulkhead("stt", pools["stt"].size, long_audio_max=LONG_AUDIO_MAX_CONCURRENCY),
+    "dialogflow": _bulkhead("dialogflow", 16),
+    "tts": _bulkhead("tts", pools["tts"].size),
+    # 1発話の間占有する枠のため優先度は付けない
+    "stt_stream": _bulkhead("stt_stream", pools["stt_stream"].size, prioritized=False),
+}
+
+
+def bulkhead_stats() -> dict:
+    return {name: bulkhead.stats() for name, bulkhead in bulkheads.items()}
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import Any, Callable
+
+import grpc
+
+logger = logging.getLogger(__name__)
+
+# アイドル時もキープアライブpingを送り、NAT/LBにコネクションを切られないようにする
+KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", int(os.environ.get("GRPC_KEEPALIVE_TIME_MS", "30000"))),
+    ("grpc.keepalive_timeout_ms", int(os.environ.get("GRPC_KEEPALIVE_TIMEOUT_MS", "10000"))),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+UNHEALTHY_STATES = (
+    grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+    grpc.ChannelConnectivity.SHUTDOWN,
+)
+
+
+class _Entry:
+    """プール内のチャネルと状態"""
+
+    def __init__(self, channel: Any, aio: bool):
+        self.channel = channel
+        self.aio = aio
+        self.state = None
+        self.unhealthy = False
+        self.created = 0
+        self.reused = 0
+        self.reconnects = 0
+
+    def healthy(self) -> bool:
+        if self.unhealthy:
+            return False
+        if self.aio:
+            return self.channel.get_state(try_to_connect=False) not in UNHEALTHY_STATES
+        return self.state not in UNHEALTHY_STATES
+
+
+class ChannelPool:
+    """リージョナルエンドポイントごとに長寿命のgRPCチャネルを保持するプール"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, bool], _Entry] = {}
+
+    def get(self, endpoint: str, create: Callable[[], Any], aio: bool = False) -> Any:
+        """
+        エンドポイントのチャネルを取得する（初回または異常時のみ作成）
+
+        Args:
+            endpoint: APIエンドポイント（例: asia-northeast1-dialogflow.googleapis.com）
+            create: チャネルを作成する関数
+            aio: grpc.aioチャネルかどうか
+
+        Returns:
+            gRPCチャネル
+        """
+        key = (endpoint, aio)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.healthy():
+                entry.reused += 1
+                return entry.channel
+
+            channel = create()
+            new_entry = _Entry(channel, aio)
+            if entry is None:
+                new_entry.created = 1
+                logger.info("gRPCチャネルを作成: %s (aio=%s)", endpoint, aio)
+            else:
+                new_entry.created = entry.created + 1
+                new_entry.reused = entry.reused
+                new_entry.reconnects = entry.reconnects + 1
+                logger.warning("gRPCチャネルが異常のため再接続: %s (aio=%s)", endpoint, aio)
+                self._close(entry)
+            self._entries[key] = new_entry
+
+        if not aio:
+            def on_state(state, entry=new_entry):
+                entry.state = state
+            channel.subscribe(on_state, try_to_connect=False)
+        return channel
+
+    def mark_unhealthy(self, endpoint: str, aio: bool = False):
+        """RPCが接続エラーで失敗した場合に呼び出し、次回取得時に再接続させる"""
+        with self._lock:
+            entry = self._entries.get((endpoint, aio))
+            if entry is not None:
+                entry.unhealthy = True
+
+    def _close(self, entry: _Entry):
+        try:
+            if entry.aio:
+                asyncio.get_running_loop().create_task(entry.channel.close())
+            else:
+                entry.channel.close()
+        except Exception as e:
+            logger.warning("gRPCチャネルのクローズに失敗: %s", e)
+
+    def reset(self):
+        """親プロセスから引き継いだチャネルを破棄する（fork後の子プロセス用、クローズはしない）"""
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    async def close_all(self):
+        """全チャネルをクローズする（シャットダウン時）"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            try:
+                if entry.aio:
+                    await entry.channel.close()
+                else:
+                    entry.channel.close()
+            except Exception as e:
+                logger.warning("gRPCチャネルのクローズに失敗: %s", e)
+        logger.info("gRPCチャネルを %d 本クローズしました", len(entries))
+
+    def stats(self) -> dict:
+        """エンドポイントごとの作成・再利用・再接続回数"""
+        with self._lock:
+            result = {}
+            for (endpoint, aio), entry in self._entries.items():
+                acquired = entry.created + entry.reused
+                result[f"{endpoint}{' (aio)' if aio else ''}"] = {
+                    "created": entry.created,
+                    "reused": entry.reused,
+                    "reconnects": entry.reconnects,
+                    "reuse_ratio": round(entry.reused / acquired, 4) if acquired else 0.0,
+                    "healthy": entry.healthy(),
+                }
+            return result
+
+
+channel_pool = ChannelPool()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """
+    Google CloudのgRPCクライアントをプロセスごとに遅延生成するレジストリ
+
+    gRPCチャネルはforkを跨いで使えないため、クライアントは初回利用時に生成し、
+    fork後の子プロセスでは親プロセスのクライアントを破棄して作り直す。
+    起動時のウォームアップでクライアントを生成してチャネルを接続し、
+    完了するまでは準備未完了（/ready が503）として扱う。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._factories: dict[str, Callable[[], Any]] = {}
+        self._probes: dict[str, Optional[Callable[[Any, float], Any]]] = {}
+        self._async_warmups: dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._clients: dict[str, Any] = {}
+        self._pid = os.getpid()
+        self.ready = False
+        self._warmup_status: dict[str, dict] = {}
+
+    def register(self, name: str, factory: Callable[[], Any], probe: Optional[Callable[[Any, float], Any]] = None):
+        """
+        クライアントの生成関数を登録する（この時点では生成しない）
+
+        Args:
+            name: クライアント名
+            factory: クライアントを生成する関数
+            probe: ウォームアップ時に呼び出す疎通確認 probe(client, timeout)
+        """
+        self._factories[name] = factory
+        self._probes[name] = probe
+
+    def register_async_warmup(self, name: str, warmup: Callable[[], Awaitable[Any]]):
+        """レジストリ外で管理するクライアント（asyncioチャネル等）のウォームアップを登録する"""
+        self._async_warmups[name] = warmup
+
+    def get(self, name: str) -> Any:
+        """クライアントを取得する（未生成またはfork後であれば生成）"""
+        if self._pid != os.getpid():
+            self.reset()
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._factories[name]()
+                    self._clients[name] = client
+                    logger.info("クライアントを生成: %s (pid=%s)", name, os.getpid())
+        return client
+
+    def reset(self):
+        """生成済みのクライアントを破棄する（fork後の子プロセスで呼ばれる）"""
+        # 親プロセスのロックが取得されたままforkされた場合に備えて作り直す
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+        self.ready = False
+        self._warmup_status = {}
+
+    def _warm_client(self, name: str, timeout: float):
+        client = self.get(name)
+        probe = self._probes.get(name)
+        if probe is not None:
+            probe(client, timeout)
+
+    async def _warm(self, name: str, warmup: Callable[[], Awaitable[Any]], timeout: float) -> bool:
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(warmup(), timeout)
+            self._warmup_status[name] = {"ok": True, "ms": round((time.monotonic() - started) * 1000, 2)}
+            return True
+        except Exception as e:
+            self._warmup_status[name] = {"ok": False, "ms": round((time.monotonic() - started) * 1000, 2), "error": str(e)}
+            logger.warning("ウォームアップに失敗: %s: %s", name, e)
+            return False
+
+    async def warmup(self, timeout: float) -> bool:
+        """全クライアントを生成してチャネルを接続し、疎通確認を行う"""
+        warmups = {
+            name: (lambda name=name: asyncio.to_thread(self._warm_client, name, timeout))
+            for name in self._factories
+        }
+        warmups.update(self._async_warmups)
+        results = await asyncio.gather(*(self._warm(name, warmup, timeout) for name, warmup in warmups.items()))
+        self.ready = all(results)
+        return self.ready
+
+    async def warmup_until_ready(self, timeout: float, retry_interval: float):
+        """ウォームアップが成功するまで一定間隔で再試行する"""
+        while not await self.warmup(timeout):
+            await asyncio.sleep(retry_interval)
+        logger.info("ウォームアップ完了: %s", self._warmup_status)
+
+    def readiness(self) -> dict:
+        return {"ready": self.ready, "clients": dict(self._warmup_status)}
+
+
+clients = ClientRegistry()
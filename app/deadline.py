@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from google.api_core.exceptions import DeadlineExceeded as RpcDeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# リクエスト全体の締め切り（秒）。X-Request-Timeoutヘッダーで短縮・延長できる
+DEFAULT_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "60"))
+MAX_DEADLINE_SECONDS = float(os.environ.get("MAX_REQUEST_DEADLINE_SECONDS", "600"))
+# これより残り時間が短いステージは実行せずにスキップする
+MIN_STAGE_SECONDS = float(os.environ.get("MIN_STAGE_SECONDS", "0.5"))
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class DeadlineExceeded(Exception):
+    """リクエストの締め切りまでにステージを完了できない"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"{stage} を実行する時間が残っていません")
+        self.stage = stage
+
+
+class Deadline:
+    """リクエスト全体の締め切りと残り時間"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    @classmethod
+    def from_headers(cls, headers) -> "Deadline":
+        """ヘッダーまたはサーバーのデフォルト値から締め切りを作成"""
+        budget = DEFAULT_DEADLINE_SECONDS
+        value = headers.get(DEADLINE_HEADER)
+        if value:
+            try:
+                budget = float(value)
+            except ValueError:
+                logger.warning("%s が不正です: %s", DEADLINE_HEADER, value)
+        return cls(min(max(budget, 0.0), MAX_DEADLINE_SECONDS))
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self, stage: str) -> float:
+        """ステージを開始できるか確認し、残り時間を返す"""
+        remaining = self.remaining()
+        if remaining < MIN_STAGE_SECONDS:
+            raise DeadlineExceeded(stage)
+        return remaining
+
+    async def run(self, stage: str, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        残り時間をtimeoutとしてfuncに渡して実行する
+
+        Args:
+            stage: ステージ名（ログ・エラー用）
+            func: timeoutキーワード引数を受け取る非同期関数
+
+        Returns:
+            funcの戻り値
+        """
+        remaining = self.check(stage)
+        try:
+            return await asyncio.wait_for(func(*args, timeout=remaining, **kwargs), remaining)
+        except (asyncio.TimeoutError, RpcDeadlineExceeded):
+            # gRPCのタイムアウトとwait_forは同じ残り時間のため、どちらが先でも締め切り超過として扱う
+            raise DeadlineExceeded(stage)
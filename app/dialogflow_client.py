@@ -1,5 +1,9 @@
+import logging
 import os
-from google.cloud.dialogflowcx_v3.services.sessions import SessionsClient
+from typing import Optional
+from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+from google.cloud.dialogflowcx_v3.services.sessions import SessionsClient, SessionsAsyncClient
+from google.cloud.dialogflowcx_v3.services.sessions.transports import SessionsGrpcTransport, SessionsGrpcAsyncIOTransport
 from google.cloud.dialogflowcx_v3.types.session import TextInput, QueryInput, DetectIntentRequest
 
 # 環境変数から設定を取得（デフォルト値付き）
@@ -7,39 +11,127 @@ PROJECT_ID = os.environ.get("DIALOGFLOW_PROJECT_ID", "rap-agent-202506")
 LOCATION_ID = os.environ.get("DIALOGFLOW_LOCATION_ID", "asia-northeast1")
 AGENT_ID = os.environ.get("DIALOGFLOW_AGENT_ID", "135b32f7-45b4-4781-8c58-9fe4044dbfa2")
 LANGUAGE_CODE = os.environ.get("DIALOGFLOW_LANGUAGE_CODE", "ja-JP")
+API_ENDPOINT = f"{LOCATION_ID}-dialogflow.googleapis.com"
 
-def detect_intent_texts(text: str, session_id: str) -> list[str]:
+logger = logging.getLogger(__name__)
+
+try:
+    from .channel_pool import channel_pool, KEEPALIVE_OPTIONS
+    from .limiter import LimitExceeded, get_limiter
+    from .clients import clients
+    from .bulkhead import bulkheads
+except ImportError:
+    from channel_pool import channel_pool, KEEPALIVE_OPTIONS
+    from limiter import LimitExceeded, get_limiter
+    from clients import clients
+    from bulkhead import bulkheads
+
+# レイテンシとエラー率に応じて同時呼び出し数を調整する
+# 上限を超えた呼び出しは隔壁で優先度順に待たせる（初期値は隔壁の枠数）
+_limiter = get_limiter("dialogflow", latency_threshold=3.0, initial_limit=bulkheads["dialogflow"].max_concurrent)
+bulkheads["dialogflow"].limit_by(_limiter.current_limit)
+
+# チャネルごとに生成したクライアントのキャッシュ（aio -> (channel, client)）
+_clients = {}
+
+def _get_client(aio: bool = False):
+    """プールされたチャネル上のSessionsクライアントを取得"""
+    transport_class = SessionsGrpcAsyncIOTransport if aio else SessionsGrpcTransport
+    channel = channel_pool.get(
+        API_ENDPOINT,
+        lambda: transport_class.create_channel(f"{API_ENDPOINT}:443", options=KEEPALIVE_OPTIONS),
+        aio=aio,
+    )
+    cached = _clients.get(aio)
+    if cached is None or cached[0] is not channel:
+        transport = transport_class(host=API_ENDPOINT, channel=channel)
+        client = SessionsAsyncClient(transport=transport) if aio else SessionsClient(transport=transport)
+        cached = (channel, client)
+        _clients[aio] = cached
+    return cached[1]
+
+async def _warmup_async():
+    """asyncioチャネルを接続済みにする（起動時のウォームアップ用）"""
+    _get_client(aio=True)
+    await _clients[True][0].channel_ready()
+
+clients.register_async_warmup("dialogflow", _warmup_async)
+
+def _rpc_options(timeout: Optional[float]) -> dict:
+    """timeout未指定の場合はライブラリのデフォルトを使う"""
+    return {"timeout": timeout} if timeout is not None else {}
+
+def _build_request(text: str, session_id: str) -> DetectIntentRequest:
+    """DetectIntentリクエストを組み立てる"""
+    session_path = f"projects/{PROJECT_ID}/locations/{LOCATION_ID}/agents/{AGENT_ID}/sessions/{session_id}"
+    text_input = TextInput(text=text)
+    query_input = QueryInput(text=text_input, language_code=LANGUAGE_CODE)
+    return DetectIntentRequest(session=session_path, query_input=query_input)
+
+def _parse_response(response) -> list[str]:
+    """DetectIntentレスポンスから応答メッセージを取り出す"""
+    response_messages = [
+        " ".join(msg.text.text) for msg in response.query_result.response_messages
+    ]
+    
+    # レスポンスが空の場合のデフォルト応答
+    if not response_messages:
+        response_messages = ["申し訳ありませんが、適切な応答を生成できませんでした。"]
+        
+    return response_messages
+
+def detect_intent_texts(text: str, session_id: str, timeout: Optional[float] = None) -> list[str]:
     """
     Dialogflow CXでテキストの意図を検出し、応答を取得する
     
     Args:
         text: ユーザーの入力テキスト
         session_id: セッションID
+        timeout: RPCのタイムアウト（秒）
         
     Returns:
         list[str]: 応答メッセージのリスト
     """
     try:
-        session_path = f"projects/{PROJECT_ID}/locations/{LOCATION_ID}/agents/{AGENT_ID}/sessions/{session_id}"
-        client_options = {"api_endpoint": f"{LOCATION_ID}-dialogflow.googleapis.com"}
-        client = SessionsClient(client_options=client_options)
-
-        text_input = TextInput(text=text)
-        query_input = QueryInput(text=text_input, language_code=LANGUAGE_CODE)
-        request = DetectIntentRequest(session=session_path, query_input=query_input)
+        client = _get_client()
 
-        response = client.detect_intent(request=request)
+        with _limiter.acquire():
+            response = client.detect_intent(request=_build_request(text, session_id), **_rpc_options(timeout))
+        return _parse_response(response)
+        
+    except (LimitExceeded, DeadlineExceeded):
+        # タイムアウトは応答文にせず呼び出し元に伝え、締め切り超過として扱わせる
+        raise
+    except Exception as e:
+        if isinstance(e, ServiceUnavailable):
+            channel_pool.mark_unhealthy(API_ENDPOINT)
+        logger.error("Dialogflow CX エラー: %s", e)
+        return [f"エラーが発生しました: {str(e)}"]
 
-        response_messages = [
-            " ".join(msg.text.text) for msg in response.query_result.response_messages
-        ]
+async def detect_intent_texts_async(text: str, session_id: str, timeout: Optional[float] = None) -> list[str]:
+    """
+    detect_intent_textsのasyncio版（SessionsAsyncClientを使用しスレッドを占有しない）
+    
+    Args:
+        text: ユーザーの入力テキスト
+        session_id: セッションID
+        timeout: RPCのタイムアウト（秒）
         
-        # レスポンスが空の場合のデフォルト応答
-        if not response_messages:
-            response_messages = ["申し訳ありませんが、適切な応答を生成できませんでした。"]
-            
-        return response_messages
+    Returns:
+        list[str]: 応答メッセージのリスト
+    """
+    try:
+        client = _get_client(aio=True)
+
+        with _limiter.acquire():
+            response = await client.detect_intent(request=_build_request(text, session_id), **_rpc_options(timeout))
+        return _parse_response(response)
         
+    except (LimitExceeded, DeadlineExceeded):
+        # タイムアウトは応答文にせず呼び出し元に伝え、締め切り超過として扱わせる
+        raise
     except Exception as e:
-        print(f"Dialogflow CX エラー: {e}")
+        if isinstance(e, ServiceUnavailable):
+            channel_pool.mark_unhealthy(API_ENDPOINT, aio=True)
+        logger.error("Dialogflow CX エラー: %s", e)
         return [f"エラーが発生しました: {str(e)}"]
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable
+
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+# クライアント切断を確認する間隔（秒）
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", "0.25"))
+
+
+class PipelineProgress:
+    """パイプラインの各ステージの完了状況（切断時に節約できた処理の計測用）"""
+
+    def __init__(self, stages: tuple[str, ...]):
+        self.stages = stages
+        self.started: list[str] = []
+        self.completed: list[str] = []
+        self.started_at = time.monotonic()
+
+    def start(self, stage: str):
+        self.started.append(stage)
+
+    def mark(self, stage: str):
+        self.completed.append(stage)
+
+    def pending(self) -> list[str]:
+        """開始していないステージ（キャンセルによって実行せずに済んだもの）"""
+        return [stage for stage in self.stages if stage not in self.started and stage not in self.completed]
+
+    def running(self) -> list[str]:
+        """開始したが完了していないステージ（依存サービスへの呼び出しは既に送信済みのことがある）"""
+        return [stage for stage in self.started if stage not in self.completed]
+
+
+# 切断によってキャンセルした処理の累計
+cancel_stats = {
+    "cancelled_requests": 0,
+    "skipped_stages": {},
+    "abandoned_stages": {},
+}
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[Any], progress: PipelineProgress) -> tuple[bool, Any]:
+    """
+    クライアントが切断したら実行中の処理をキャンセルする
+
+    Returns:
+        (切断されたかどうか, 処理結果)
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return False, task.result()
+            if await request.is_disconnected():
+                break
+    except BaseException:
+        task.cancel()
+        raise
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.debug("キャンセル後の例外: %s", e)
+
+    pending = progress.pending()
+    running = progress.running()
+    cancel_stats["cancelled_requests"] += 1
+    for stage in pending:
+        cancel_stats["skipped_stages"][stage] = cancel_stats["skipped_stages"].get(stage, 0) + 1
+    for stage in running:
+        cancel_stats["abandoned_stages"][stage] = cancel_stats["abandoned_stages"].get(stage, 0) + 1
+    logger.info(
+        "クライアント切断のため処理をキャンセル: 完了=%s, 実行中=%s, 未実行=%s, 経過=%.2f秒",
+        progress.completed, running, pending, time.monotonic() - progress.started_at
+    )
+    return True, None
@@ -0,0 +1,10 @@
+class Overloaded(Exception):
+    """サーバーまたは依存サービスが飽和しているため処理を受け付けられない"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PayloadTooLarge(Exception):
+    """アップロードがサイズまたは長さの上限を超えた"""
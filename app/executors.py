@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# 依存サービスごとのデフォルトスレッド数（環境変数 {NAME}_POOL_SIZE で上書き可能）
+# Dialogflow CXはasyncioクライアントで呼び出すためスレッドプールを持たない
+DEFAULT_POOL_SIZES = {
+    "stt": 8,
+    "tts": 8,
+    "stt_stream": 8,  # WebSocketのストリーミング認識（発話の間スレッドを占有する）
+    "jobs": 2,  # 音声ジョブのファイル入出力
+    "audio": 2,  # 音声ファイルの入出力（音声ストア・ディスクに退避したアップロード）
+}
+
+
+def _pool_size(name: str) -> int:
+    """環境変数からプールサイズを取得"""
+    value = os.environ.get(f"{name.upper()}_POOL_SIZE")
+    if value:
+        try:
+            return max(1, int(value))
+        except ValueError:
+            logger.warning("%s_POOL_SIZE が不正です: %s", name.upper(), value)
+    return DEFAULT_POOL_SIZES[name]
+
+
+class DependencyPool:
+    """依存サービス専用のスレッドプール（待ち行列長と待ち時間を計測）"""
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{name}-worker")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """同期関数をプール上で実行し、イベントループをブロックせずに結果を待つ"""
+        submitted = time.monotonic()
+        started = False
+
+        def task():
+            nonlocal started
+            wait = time.monotonic() - submitted
+            with self._lock:
+                started = True
+                self._queued -= 1
+                self._active += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        def on_done(future):
+            # 実行前にキャンセルされたタスクは待ち行列から外す
+            if future.cancelled():
+                with self._lock:
+                    if not started:
+                        self._queued -= 1
+
+        with self._lock:
+            self._queued += 1
+        # 相関IDなどのコンテキスト変数をワーカースレッドに引き継ぐ
+        future = self._executor.submit(contextvars.copy_context().run, task)
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self._completed + self._active
+            return {
+                "size": self.size,
+                "active": self._active,
+                "queue_depth": self._queued,
+                "completed": self._completed,
+                "avg_wait_ms": round(self._total_wait / started * 1000, 2) if started else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 2),
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+pools = {name: DependencyPool(name, _pool_size(name)) for name in DEFAULT_POOL_SIZES}
+
+
+async def run_in_pool(name: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """指定した依存サービスのプールで同期関数を実行"""
+    return await pools[name].run(func, *args, **kwargs)
+
+
+def reset_pools():
+    """プールを作り直す（fork後の子プロセスでは親のワーカースレッドが存在しないため）"""
+    for name in list(pools):
+        pools[name] = DependencyPool(name, _pool_size(name))
+
+
+def shutdown_pools():
+    """全プールを停止する（未実行のタスクは破棄）"""
+    for pool in pools.values():
+        pool.shutdown(wait=False)
+
+
+def pool_stats() -> dict:
+    """全プールの統計情報を取得"""
+    return {name: pool.stats() for name, pool in pools.items()}
@@ -0,0 +1,31 @@
+import logging
+import os
+
+try:
+    from .channel_pool import channel_pool
+    from .clients import clients
+    from .executors import reset_pools
+    from . import log_config
+except ImportError:
+    from channel_pool import channel_pool
+    from clients import clients
+    from executors import reset_pools
+    import log_config
+
+logger = logging.getLogger(__name__)
+
+
+def reinitialize_after_fork():
+    """
+    fork後の子プロセスで、親プロセスから引き継いだgRPCクライアント・チャネルと
+    スレッドプールを破棄する（次回利用時に子プロセスで作り直される）。
+    ログの書き出しスレッドも作り直す
+    """
+    log_config.reinitialize_after_fork()
+    clients.reset()
+    channel_pool.reset()
+    reset_pools()
+    logger.info("fork後の再初期化を行いました (pid=%s)", os.getpid())
+
+
+os.register_at_fork(after_in_child=reinitialize_after_fork)
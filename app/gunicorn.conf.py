@@ -0,0 +1,26 @@
+# マルチワーカー構成のgunicorn設定
+# 使い方: cd app && gunicorn -c gunicorn.conf.py api_server:app
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+# デフォルトは1ワーカー。セッションのターンの直列化と処理中の再送の合流はプロセス内の状態のため、
+# 複数ワーカーでは別のワーカーに届いた同じセッションのターンが並行して実行される。
+# また、ワーカーごとに音声ジョブ用のプロセス（VOICE_JOB_WORKERS）を起動する
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# fork前にアプリケーション（依存ライブラリ・protoの型定義等）を読み込み、
+# 読み取り専用のメモリをワーカー間で共有する。gRPCクライアントはfork後に各ワーカーで生成される
+preload_app = True
+
+# SIGTERM後に処理中のリクエストの完了を待つ時間
+graceful_timeout = int(float(os.environ.get("SHUTDOWN_GRACE_PERIOD", "8")))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "620"))
+keepalive = 5
+loglevel = "info"
+
+
+def pre_fork(server, worker):
+    # preload済みのオブジェクトをGCの対象外にし、fork後のコピーオンライトによるメモリ複製を防ぐ
+    gc.freeze()
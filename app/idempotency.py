@@ -0,0 +1,233 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from starlette.responses import Response
+
+try:
+    from .executors import run_in_pool
+except ImportError:
+    from executors import run_in_pool
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# 完了した結果の保存先（ワーカープロセス間で共有）
+IDEMPOTENCY_DIR = os.environ.get("IDEMPOTENCY_DIR", "/tmp/idempotency")
+
+
+class IdempotencyKeyMismatch(Exception):
+    """同じIdempotency-Keyが内容の異なるリクエストに使われた"""
+
+
+def request_fingerprint(*parts: Optional[str]) -> str:
+    """リクエストの内容（本文・セッション等）のハッシュ。同じキーの再送が同じ内容かの確認に使う"""
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class _Retry(Exception):
+    """元のリクエストが失敗したため、待機中の重複リクエストが処理をやり直す"""
+
+
+class _Entry:
+    def __init__(self, ttl: float, fingerprint: str):
+        self.future = asyncio.get_running_loop().create_future()
+        self.expires_at = time.monotonic() + ttl
+        self.fingerprint = fingerprint
+
+
+def _snapshot(response: Response) -> tuple:
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-type")}
+    return response.status_code, response.body, response.media_type, headers
+
+
+def _verify(key: str, expected: str, fingerprint: str):
+    if expected != fingerprint:
+        logger.warning("内容の異なるリクエストにIdempotency-Keyが再利用されました: %s", key)
+        raise IdempotencyKeyMismatch("このIdempotency-Keyは内容の異なるリクエストに使用済みです")
+
+
+def _restore(snapshot: tuple) -> Response:
+    status_code, body, media_type, headers = snapshot
+    response = Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+class _ResultFiles:
+    """完了した結果をローカルファイルに保存する（ワーカープロセス間で共有）"""
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_purge = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        # キーはクライアントが指定するため、ハッシュをファイル名にする（パス操作を防ぐ）
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key: str) -> Optional[tuple[str, tuple]]:
+        """保存されている (内容のハッシュ, レスポンス)。ない場合・期限切れの場合はNone"""
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if stored["expires_at"] <= time.time():
+            return None
+        snapshot = (stored["status_code"], base64.b64decode(stored["body"]), stored["media_type"], stored["headers"])
+        return stored["fingerprint"], snapshot
+
+    def put(self, key: str, fingerprint: str, snapshot: tuple):
+        status_code, body, media_type, headers = snapshot
+        stored = {
+            "fingerprint": fingerprint,
+            "expires_at": time.time() + self.ttl,
+            "status_code": status_code,
+            "body": base64.b64encode(body).decode("ascii"),
+            "media_type": media_type,
+            "headers": headers,
+        }
+        # 読み取り側が書きかけのファイルを読まないように置き換えで書き込む
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._purge_expired()
+
+    def _purge_expired(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        cutoff = now - self.ttl
+        for name in os.listdir(self.directory):
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) < cutoff:
+                    os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+
+
+class IdempotencyStore:
+    """
+    Idempotency-Keyごとに成功したレスポンスをTTLの間保持する
+
+    同じキーのリクエストが処理中に届いた場合は、新たに処理を始めずに元の結果を待つ。
+    元のリクエストが失敗した場合は結果を保持せず、待機中のリクエストの1つが処理をやり直す。
+    処理中のリクエストはプロセスごとに管理し、完了した結果はファイルに保存して他のワーカープロセスからも再利用する。
+    キーにはリクエストの内容のハッシュを対応付け、同じキーで内容の異なるリクエストはIdempotencyKeyMismatchとする。
+    """
+
+    def __init__(self, ttl: float, max_entries: int, directory: str):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._files = _ResultFiles(directory, ttl)
+        self._executed = 0
+        self._replayed = 0
+        self._joined = 0
+        self._mismatched = 0
+
+    def _purge(self):
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            if not entry.future.done():
+                # 処理中のエントリは削除しない
+                break
+            del self._entries[key]
+
+    async def run(self, key: str, fingerprint: str, handler: Callable[[], Awaitable[Response]]) -> Response:
+        """
+        キーに対応する結果があれば再利用し、なければhandlerを実行して結果を保持する
+
+        Args:
+            fingerprint: リクエストの内容のハッシュ（request_fingerprint）
+
+        Raises:
+            IdempotencyKeyMismatch: キーが内容の異なるリクエストに使用済み
+        """
+        try:
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires_at <= time.monotonic() and entry.future.done():
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    # 他のワーカープロセスで完了した結果
+                    stored = await run_in_pool("audio", self._files.get, key)
+                    if stored is not None:
+                        _verify(key, stored[0], fingerprint)
+                        self._replayed += 1
+                        return _restore(stored[1])
+                    if key in self._entries:
+                        # 確認している間に同じプロセスで処理が始まった
+                        continue
+                    break
+                _verify(key, entry.fingerprint, fingerprint)
+                if entry.future.done():
+                    self._replayed += 1
+                else:
+                    self._joined += 1
+                    logger.info("処理中の同一リクエストの結果を待ちます: %s", key)
+                try:
+                    return _restore(await asyncio.shield(entry.future))
+                except _Retry:
+                    continue
+        except IdempotencyKeyMismatch:
+            self._mismatched += 1
+            raise
+
+        entry = _Entry(self.ttl, fingerprint)
+        self._entries[key] = entry
+        self._purge()
+        self._executed += 1
+        try:
+            response = await handler()
+        except BaseException:
+            self._discard(key, entry)
+            raise
+
+        if 200 <= response.status_code < 300 and hasattr(response, "body"):
+            snapshot = _snapshot(response)
+            entry.future.set_result(snapshot)
+            try:
+                await run_in_pool("audio", self._files.put, key, fingerprint, snapshot)
+            except OSError as e:
+                # 保存できなくても同じプロセス内の再送には応答できる
+                logger.warning("再送用の結果を保存できませんでした: %s", e)
+        else:
+            self._discard(key, entry)
+        return response
+
+    def _discard(self, key: str, entry: _Entry):
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+        entry.future.set_exception(_Retry())
+        # 待機者がいない場合に「例外が取得されなかった」警告を出さない
+        entry.future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "executed": self._executed,
+            "replayed": self._replayed,
+            "joined_in_flight": self._joined,
+            "mismatched": self._mismatched,
+        }
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_DIR)
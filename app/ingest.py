@@ -0,0 +1,319 @@
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from typing import BinaryIO, Optional
+
+from starlette.requests import Request
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+try:
+    from .errors import Overloaded, PayloadTooLarge
+    from .executors import run_in_pool
+except ImportError:
+    from errors import Overloaded, PayloadTooLarge
+    from executors import run_in_pool
+
+logger = logging.getLogger(__name__)
+
+# アップロードの上限（超えた時点で受信を打ち切る）
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_MAX_SECONDS = float(os.environ.get("UPLOAD_MAX_SECONDS", "600"))
+# これを超えたアップロードはメモリではなくディスクに退避する
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+# 受信中・処理中のアップロードが同時に使える合計バイト数（Cloud Runの/tmpはメモリのため）
+UPLOAD_INGEST_BUDGET_BYTES = int(os.environ.get("UPLOAD_INGEST_BUDGET_BYTES", str(64 * 1024 * 1024)))
+UPLOAD_RETRY_AFTER = int(os.environ.get("UPLOAD_RETRY_AFTER", "2"))
+# multipartの境界・ヘッダー等のオーバーヘッドとして許容する量
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# 形式判定・長さの推定に使う先頭部分の大きさ
+SNIFF_BYTES = 16 * 1024
+
+# MPEG-1 Layer IIIのビットレート（kbps）
+MP3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0]
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """先頭のバイト列から音声形式を判定する"""
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:3] == b"ID3" or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    if head[4:8] == b"ftyp":
+        return "m4a"
+    return None
+
+
+def _byte_rate(audio_format: Optional[str], head: bytes) -> Optional[float]:
+    """1秒あたりのバイト数（ヘッダーから分かる形式のみ。分からない場合はNone）"""
+    if audio_format == "wav" and len(head) >= 32:
+        return struct.unpack_from("<I", head, 28)[0] or None
+    if audio_format == "mp3":
+        offset = 0
+        if head[:3] == b"ID3" and len(head) >= 10:
+            # ID3v2タグ（サイズはsyncsafe整数）を読み飛ばす
+            size = head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9]
+            offset = 10 + size
+        if len(head) >= offset + 4 and head[offset] == 0xFF and head[offset + 1] & 0xFE == 0xFA:
+            kbps = MP3_BITRATES[head[offset + 2] >> 4]
+            return kbps * 1000 / 8 if kbps else None
+    return None
+
+
+class IngestBudget:
+    """
+    取り込み中・処理中のアップロードが使うバイト数の合計を制限する
+
+    受信を始める前に見込みのバイト数（Content-Length、不明な場合は上限）を予約し、
+    予算を超える場合は本文を受信せずにOverloadedを送出する。予約はAudioIngest.close()で返却する。
+    """
+
+    def __init__(self, max_bytes: int, retry_after: int):
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._active = 0
+        self._rejected = 0
+
+    def reserve(self, nbytes: int) -> int:
+        with self._lock:
+            if self._reserved + nbytes > self.max_bytes:
+                self._rejected += 1
+                logger.warning("アップロードの受け入れを拒否しました: 使用中 %d bytes + %d bytes", self._reserved, nbytes)
+                raise Overloaded("アップロードが混雑しています。しばらくしてから再試行してください。", self.retry_after)
+            self._reserved += nbytes
+            self._active += 1
+        return nbytes
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self._reserved -= nbytes
+            self._active -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "reserved_bytes": self._reserved,
+                "active": self._active,
+                "rejected": self._rejected,
+            }
+
+
+ingest_budget = IngestBudget(UPLOAD_INGEST_BUDGET_BYTES, UPLOAD_RETRY_AFTER)
+
+
+class AudioIngest:
+    """
+    アップロードされる音声をチャンクごとに受け取り、
+    ハッシュの計算・形式の判定・長さの推定を行いながら一時ファイルに書き込む（一定量を超えるとディスクに退避）
+    """
+
+    def __init__(self, filename: Optional[str] = None, max_bytes: int = UPLOAD_MAX_BYTES,
+                 max_seconds: float = UPLOAD_MAX_SECONDS, spool_bytes: int = UPLOAD_SPOOL_BYTES,
+                 reserved_bytes: int = 0):
+        """
+        Args:
+            reserved_bytes: ingest_budgetから予約済みのバイト数（close()で返却する）
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.format: Optional[str] = None
+        self.byte_rate: Optional[float] = None
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self._file: BinaryIO = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self._reserved_bytes = reserved_bytes
+
+    @property
+    def spooled(self) -> bool:
+        """ディスクに退避済みかどうか"""
+        return getattr(self._file, "_rolled", True)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def audio_filename(self) -> Optional[str]:
+        """STTの形式判定に渡すファイル名（先頭のバイト列から判定できた形式を優先する）"""
+        if self.format:
+            return f"audio.{self.format}"
+        return self.filename
+
+    def estimated_seconds(self) -> Optional[float]:
+        return self.size / self.byte_rate if self.byte_rate else None
+
+    def feed(self, chunk: bytes):
+        """
+        チャンクを追加する
+
+        Raises:
+            PayloadTooLarge: サイズまたは推定した長さが上限を超えた
+        """
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise PayloadTooLarge(f"音声ファイルが大きすぎます（上限 {self.max_bytes} bytes）")
+        if len(self._head) < SNIFF_BYTES:
+            self._head += chunk[:SNIFF_BYTES - len(self._head)]
+            self.format = sniff_format(self._head)
+            self.byte_rate = _byte_rate(self.format, self._head)
+        seconds = self.estimated_seconds()
+        if seconds is not None and seconds > self.max_seconds:
+            raise PayloadTooLarge(f"音声が長すぎます（上限 {self.max_seconds:.0f} 秒）")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def feed_all(self, chunks: list[bytes]):
+        for chunk in chunks:
+            self.feed(chunk)
+
+    async def feed_async(self, chunks: list[bytes]):
+        """
+        チャンクをまとめて追加する
+
+        ディスクに退避する（した）場合は書き込みとハッシュの計算をスレッドプールで行い、イベントループを止めない
+        """
+        if self.spooled or self.size + sum(map(len, chunks)) > self.spool_bytes:
+            await run_in_pool("audio", self.feed_all, chunks)
+        else:
+            self.feed_all(chunks)
+
+    def read(self) -> bytes:
+        """受け取った音声全体を読み込む"""
+        self._file.seek(0)
+        return self._file.read()
+
+    def copy_to(self, path: str):
+        """受け取った音声をファイルに書き出す（メモリに全体を読み込まない）"""
+        self._file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self._file, f)
+
+    def close(self):
+        self._file.close()
+        if self._reserved_bytes:
+            ingest_budget.release(self._reserved_bytes)
+            self._reserved_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "sha256": self.sha256,
+            "format": self.format,
+            "estimated_seconds": self.estimated_seconds(),
+            "spooled": self.spooled,
+        }
+
+
+async def ingest_request(request: Request, field: str = "file") -> AudioIngest:
+    """
+    multipart/form-data（またはaudio/*の本文）のアップロードを受信しながら取り込む
+
+    本文全体を受信・バッファリングする前に、上限を超えた時点でPayloadTooLargeを送出する
+
+    Args:
+        request: リクエスト
+        field: 音声を含むフォームのフィールド名
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES:
+        raise PayloadTooLarge(f"音声ファイルが大きすぎます（上限 {UPLOAD_MAX_BYTES} bytes）")
+    # 同時に受信できるアップロードの合計バイト数を制限する（長さが不明な場合は上限分を予約する）
+    expected = min(int(content_length), UPLOAD_MAX_BYTES) if content_length and content_length.isdigit() else UPLOAD_MAX_BYTES
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data":
+        # 音声を本文としてそのまま送る場合
+        ingest = AudioIngest(request.headers.get("x-filename"), reserved_bytes=ingest_budget.reserve(expected))
+        try:
+            async for chunk in request.stream():
+                await ingest.feed_async([chunk])
+        except BaseException:
+            ingest.close()
+            raise
+        return ingest
+
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise ValueError("multipartの境界が指定されていません")
+    reserved = ingest_budget.reserve(expected)
+
+    ingest: Optional[AudioIngest] = None
+    pending: list[bytes] = []
+    state = {"header_field": b"", "header_value": b"", "headers": {}, "in_file": False}
+
+    def on_part_begin():
+        state["headers"] = {}
+        state["in_file"] = False
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = state["header_value"] = b""
+
+    def on_headers_finished():
+        nonlocal ingest
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        if options.get(b"name", b"").decode("utf-8", "replace") == field and ingest is None:
+            filename = options.get(b"filename")
+            ingest = AudioIngest(filename.decode("utf-8", "replace") if filename else None, reserved_bytes=reserved)
+            state["in_file"] = True
+
+    def on_part_data(data, start, end):
+        if state["in_file"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        state["in_file"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if pending:
+                # 受信したチャンク単位でまとめて書き込む（退避後はスレッドプールで行う）
+                data = pending[:]
+                pending.clear()
+                await ingest.feed_async(data)
+        parser.finalize()
+    except BaseException:
+        if ingest is not None:
+            ingest.close()
+        else:
+            ingest_budget.release(reserved)
+        raise
+
+    if ingest is None:
+        ingest_budget.release(reserved)
+        raise ValueError(f"フォームに {field} がありません")
+    return ingest
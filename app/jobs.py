@@ -0,0 +1,207 @@
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# ジョブの保存先・ワーカープロセス数・保持期間
+VOICE_JOB_DIR = os.environ.get("VOICE_JOB_DIR", "/tmp/voice_jobs")
+VOICE_JOB_WORKERS = int(os.environ.get("VOICE_JOB_WORKERS", "2"))
+VOICE_JOB_TTL = float(os.environ.get("VOICE_JOB_TTL", "3600"))
+
+
+class JobStore:
+    """音声ジョブの状態と入力音声をローカルファイルに保存するストア（プロセス間で共有）"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def audio_path(self, job_id: str) -> str:
+        return self._path(job_id, "audio")
+
+    def create(self, upload, filename: Optional[str]) -> dict:
+        """
+        ジョブを作成する
+
+        Args:
+            upload: 取り込んだ音声（copy_to(path) でファイルに書き出せるもの）
+            filename: 元のファイル名（形式判定に使用）
+        """
+        job_id = str(uuid.uuid4())
+        upload.copy_to(self.audio_path(job_id))
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "stage": None,
+            "filename": filename,
+            "created_at": now,
+            "updated_at": now,
+            "result": None,
+            "error": None,
+        }
+        self._write(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        try:
+            # パス操作を防ぐためUUID形式のIDのみ受け付ける
+            job_id = str(uuid.UUID(job_id))
+        except ValueError:
+            return None
+        try:
+            with open(self._path(job_id, "json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def update(self, job_id: str, **fields) -> Optional[dict]:
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job["updated_at"] = time.time()
+        self._write(job)
+        return job
+
+    def _write(self, job: dict):
+        # 読み取り側が書きかけのファイルを読まないように置き換えで書き込む
+        path = self._path(job["job_id"], "json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def purge_expired(self, ttl: float) -> int:
+        """保持期間を過ぎたジョブを削除する"""
+        removed = 0
+        cutoff = time.time() - ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+def run_voice_job(directory: str, job_id: str):
+    """
+    ワーカープロセスで音声パイプライン（STT→Dialogflow→TTS）を実行し、進捗をストアに書き込む
+    """
+    try:
+        from .dialogflow_client import detect_intent_texts
+        from .stt import transcribe_audio
+        from .tts import synthesize_speech
+    except ImportError:
+        from dialogflow_client import detect_intent_texts
+        from stt import transcribe_audio
+        from tts import synthesize_speech
+
+    store = JobStore(directory)
+    job = store.update(job_id, status="running", stage="stt")
+    if job is None:
+        return
+    try:
+        with open(store.audio_path(job_id), "rb") as f:
+            audio_content = f.read()
+        transcript = transcribe_audio(audio_content, job["filename"])
+        if not transcript or transcript.startswith("音声認識中にエラーが発生しました"):
+            store.update(job_id, status="failed", error="音声を認識できませんでした")
+            return
+
+        store.update(job_id, stage="dialogflow", result={"transcript": transcript})
+        session_id = str(uuid.uuid4())
+        response_messages = detect_intent_texts(transcript, session_id)
+        response_text = " ".join(response_messages) if response_messages else "すみません、応答を生成できませんでした。"
+
+        result = {"transcript": transcript, "response": response_text, "session_id": session_id, "audio_base64": None}
+        store.update(job_id, stage="tts", result=result)
+        try:
+            result["audio_base64"] = base64.b64encode(synthesize_speech(response_text)).decode("utf-8")
+        except Exception as tts_error:
+            logger.warning("TTS error: %s", tts_error)
+
+        store.update(job_id, status="succeeded", stage=None, result=result)
+    except Exception as e:
+        logger.error("音声ジョブの処理に失敗: %s: %s", job_id, e)
+        store.update(job_id, status="failed", error=str(e))
+    finally:
+        try:
+            os.remove(store.audio_path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+class VoiceJobQueue:
+    """音声ジョブをワーカープロセスのプールで実行するキュー"""
+
+    def __init__(self, directory: str, workers: int, ttl: float):
+        self.store = JobStore(directory)
+        self.workers = workers
+        self.ttl = ttl
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._submitted = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 初回投入時に生成する（gunicornのマスタープロセスでは生成しない）
+        # gRPCはforkと相性が悪いため、ワーカープロセスはspawnで起動する
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def submit(self, upload, filename: Optional[str]) -> dict:
+        """ジョブを登録してワーカープロセスに投入する"""
+        now = time.time()
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            removed = self.store.purge_expired(self.ttl)
+            if removed:
+                logger.info("期限切れの音声ジョブファイルを %d 件削除しました", removed)
+
+        job = self.store.create(upload, filename)
+        future = self._get_executor().submit(run_voice_job, self.store.directory, job["job_id"])
+        self._submitted += 1
+
+        def on_done(future, job_id=job["job_id"]):
+            error = future.exception() if not future.cancelled() else None
+            if future.cancelled() or error is not None:
+                # ワーカープロセスの異常終了などでジョブが完了しなかった場合
+                self.store.update(job_id, status="failed", error=str(error) if error else "cancelled")
+
+        future.add_done_callback(on_done)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get(job_id)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "submitted": self._submitted}
+
+
+voice_jobs = VoiceJobQueue(VOICE_JOB_DIR, VOICE_JOB_WORKERS, VOICE_JOB_TTL)
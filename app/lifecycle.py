@@ -0,0 +1,141 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import signal
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# SIGTERM受信後、処理中のリクエストの完了を待つ最大時間（秒）
+SHUTDOWN_GRACE_PERIOD = float(os.environ.get("SHUTDOWN_GRACE_PERIOD", "8"))
+
+
+class Lifecycle:
+    """ドレイン（新規受付停止→処理中リクエストの完了待ち→リソース解放）を管理する"""
+
+    def __init__(self):
+        self.draining = False
+        self._inflight = 0
+        self._cleanups: list[Callable] = []
+
+    def begin_drain(self):
+        """新規リクエストの受け付けを停止する"""
+        if not self.draining:
+            self.draining = True
+            logger.info("ドレインを開始します: 処理中 %d 件", self._inflight)
+
+    def request_started(self):
+        self._inflight += 1
+
+    def request_finished(self):
+        self._inflight -= 1
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def add_cleanup(self, cleanup: Callable):
+        """シャットダウン時に呼び出す後始末を登録（同期・非同期どちらも可、登録の逆順に実行）"""
+        self._cleanups.append(cleanup)
+
+    def install_signal_handlers(self):
+        """SIGTERM/SIGINTで即座にドレインを開始し、既存のハンドラー（uvicorn等）に処理を引き継ぐ"""
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(sig)
+            if not callable(previous):
+                # サーバーがシグナルを処理していない場合はデフォルト動作（終了）を変えない
+                continue
+
+            def handler(signum, frame, previous=previous):
+                self.begin_drain()
+                previous(signum, frame)
+
+            try:
+                signal.signal(sig, handler)
+            except ValueError:
+                # メインスレッド以外では登録できない
+                logger.warning("シグナルハンドラーを登録できませんでした")
+                return
+
+    async def shutdown(self, grace_period: float = SHUTDOWN_GRACE_PERIOD):
+        """処理中のリクエストの完了を待ってからリソースを解放する"""
+        self.begin_drain()
+        started = time.monotonic()
+        while self._inflight > 0 and time.monotonic() - started < grace_period:
+            await asyncio.sleep(0.1)
+        if self._inflight > 0:
+            logger.warning("猶予時間 %s秒 を超えたため %d 件の処理を打ち切ります", grace_period, self._inflight)
+        else:
+            logger.info("処理中のリクエストが完了しました (%.2f秒)", time.monotonic() - started)
+
+        for cleanup in reversed(self._cleanups):
+            try:
+                result = cleanup()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error("シャットダウン処理に失敗: %s", e)
+
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
+
+lifecycle = Lifecycle()
+
+
+class DrainMiddleware:
+    """
+    ドレイン中は新規リクエストを拒否し、処理中のリクエスト数を数えるASGIミドルウェア
+
+    receive/sendをそのまま渡すため、ハンドラー側の切断検出（http.disconnect）を妨げない。
+    ストリーミング応答も含め、本文の最後のチャンクを送り終えた時点で処理完了とする
+    """
+
+    def __init__(self, app, lifecycle: Lifecycle, exempt_paths: set):
+        self.app = app
+        self.lifecycle = lifecycle
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+        if self.lifecycle.draining:
+            await self._reject(send)
+            return
+
+        self.lifecycle.request_started()
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if not finished:
+                finished = True
+                self.lifecycle.request_finished()
+
+        async def send_wrapper(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+
+    async def _reject(self, send):
+        body = json.dumps({"error": "サーバーを停止しています。再試行してください。"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", b"1"),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
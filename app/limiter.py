@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from google.api_core.exceptions import ClientError, DeadlineExceeded, ResourceExhausted
+
+try:
+    from .errors import Overloaded
+except ImportError:
+    from errors import Overloaded
+
+logger = logging.getLogger(__name__)
+
+
+class LimitExceeded(Overloaded):
+    """依存サービスへの同時呼び出し数が現在の上限に達している"""
+
+
+def is_overload_error(e: Exception) -> bool:
+    """上限を縮小すべきエラーか判定（リクエスト自体の誤りによる4xxは対象外）"""
+    return not isinstance(e, ClientError) or isinstance(e, ResourceExhausted)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD方式で同時呼び出し数の上限を調整するリミッター
+
+    成功かつ上限の半分以上を使っている場合は上限を1増やし、
+    エラーまたはレイテンシが閾値を超えた場合は上限に backoff を掛けて縮小する。
+    スレッドとイベントループの両方から利用できる。
+    上限に達した呼び出しは即座に拒否するため、待たせる場合は隔壁の実行枠を current_limit() に連動させる。
+    """
+
+    def __init__(self, name: str, latency_threshold: float, initial_limit: int = 10,
+                 min_limit: int = 2, max_limit: int = 100, backoff: float = 0.9):
+        self.name = name
+        self.latency_threshold = latency_threshold
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._limit = float(initial_limit)
+        self._inflight = 0
+        self._latency_ewma = 0.0
+        self._successes = 0
+        self._drops = 0
+        self._rejected = 0
+
+    @contextmanager
+    def acquire(self):
+        """呼び出し枠を取得する。上限に達している場合はLimitExceededを送出"""
+        with self._lock:
+            if self._inflight >= int(self._limit):
+                self._rejected += 1
+                raise LimitExceeded(f"{self.name} の同時呼び出し数が上限({int(self._limit)})に達しています")
+            self._inflight += 1
+
+        started = time.monotonic()
+        outcome = "success"
+        try:
+            yield
+        except DeadlineExceeded:
+            # 呼び出し側の締め切り（X-Request-Timeout等）が閾値より短くて打ち切られた場合は過負荷とみなさない
+            # （閾値を超えてから打ち切られた場合はレイテンシの超過として縮小する）
+            outcome = "drop" if time.monotonic() - started > self.latency_threshold else "ignore"
+            raise
+        except Exception as e:
+            outcome = "drop" if is_overload_error(e) else "ignore"
+            raise
+        except BaseException:
+            # 締め切り（Deadline.runのwait_for）によるキャンセルは、閾値を超えて応答がなかった場合のみ縮小する
+            # （gRPCのタイムアウトより先に発生するため、ここで数えないと応答しない依存サービスで上限が縮小しない）
+            outcome = "drop" if time.monotonic() - started > self.latency_threshold else "ignore"
+            raise
+        finally:
+            self._release(time.monotonic() - started, outcome)
+
+    def current_limit(self) -> int:
+        """現在の同時呼び出し数の上限"""
+        return int(self._limit)
+
+    def _release(self, latency: float, outcome: str):
+        with self._lock:
+            self._inflight -= 1
+            if outcome == "ignore":
+                return
+            self._latency_ewma = latency if self._latency_ewma == 0.0 else 0.8 * self._latency_ewma + 0.2 * latency
+            if outcome == "drop" or latency > self.latency_threshold:
+                self._drops += 1
+                new_limit = max(self.min_limit, self._limit * self.backoff)
+                if int(new_limit) < int(self._limit):
+                    logger.warning("%s: 同時呼び出し数の上限を縮小 %d -> %d (レイテンシ %.2f秒)", self.name, int(self._limit), int(new_limit), latency)
+                self._limit = new_limit
+            else:
+                self._successes += 1
+                if self._inflight + 1 >= self._limit / 2:
+                    self._limit = min(self.max_limit, self._limit + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": int(self._limit),
+                "inflight": self._inflight,
+                "latency_ewma_ms": round(self._latency_ewma * 1000, 2),
+                "latency_threshold_ms": round(self.latency_threshold * 1000, 2),
+                "successes": self._successes,
+                "drops": self._drops,
+                "rejected": self._rejected,
+            }
+
+
+_limiters: dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, latency_threshold: float, initial_limit: int = 10) -> AdaptiveLimiter:
+    """
+    依存サービスのリミッターを取得（環境変数 {NAME}_LATENCY_THRESHOLD / {NAME}_MAX_LIMIT で調整可能）
+
+    Args:
+        initial_limit: 同時呼び出し数の初期値（連動する隔壁の枠数に揃え、起動直後に拒否しないようにする）
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            prefix = name.upper()
+            limiter = AdaptiveLimiter(
+                name,
+                latency_threshold=float(os.environ.get(f"{prefix}_LATENCY_THRESHOLD", str(latency_threshold))),
+                initial_limit=int(os.environ.get(f"{prefix}_INITIAL_LIMIT", str(initial_limit))),
+                min_limit=int(os.environ.get(f"{prefix}_MIN_LIMIT", "2")),
+                max_limit=int(os.environ.get(f"{prefix}_MAX_LIMIT", "100")),
+            )
+            _limiters[name] = limiter
+        return limiter
+
+
+def limiter_stats() -> dict:
+    with _limiters_lock:
+        return {name: limiter.stats() for name, limiter in _limiters.items()}
@@ -0,0 +1,167 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+# リクエストごとの相関ID（ミドルウェアが設定し、ログレコードに付与する）
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# 大きなペイロード（リクエスト・応答テキスト）をログに出す割合と最大文字数
+LOG_BODY_SAMPLE_RATE = float(os.environ.get("LOG_BODY_SAMPLE_RATE", "0.01"))
+LOG_BODY_MAX_CHARS = int(os.environ.get("LOG_BODY_MAX_CHARS", "200"))
+
+_listener = None
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+class _RequestIdFilter(logging.Filter):
+    """ログ呼び出し時点の相関IDをレコードに付与する"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """メッセージを整形せずにキューへ渡す（整形はバックグラウンドスレッドで行う）"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Cloud Loggingで扱いやすい1行JSON形式のフォーマッター"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _SampledBody:
+    """ログ出力時にだけ評価されるペイロード（サンプリング・切り詰め付き）"""
+
+    __slots__ = ("value", "sampled")
+
+    def __init__(self, value):
+        self.value = value
+        self.sampled = random.random() < LOG_BODY_SAMPLE_RATE
+
+    def __str__(self) -> str:
+        text = str(self.value)
+        if not self.sampled:
+            return f"<{len(text)} chars omitted>"
+        if len(text) > LOG_BODY_MAX_CHARS:
+            return f"{text[:LOG_BODY_MAX_CHARS]}...<{len(text) - LOG_BODY_MAX_CHARS} chars truncated>"
+        return text
+
+
+def sample_body(value) -> _SampledBody:
+    """大きなペイロードをLOG_BODY_SAMPLE_RATEの割合でのみログに出す"""
+    return _SampledBody(value)
+
+
+def setup_logging():
+    """ルートロガーをバックグラウンドスレッド経由の構造化ログに設定する（複数回呼んでも1回だけ）"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(_RequestIdFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def flush_logging():
+    """キューに残っているログを書き出す（バックグラウンドスレッドは再開する）"""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+def reinitialize_after_fork():
+    """fork後の子プロセスでは書き出しスレッドが存在しないため作り直す"""
+    global _listener
+    if _listener is not None:
+        _listener = None
+        setup_logging()
+
+
+def stop_logging():
+    """キューに残っているログを書き出してバックグラウンドスレッドを停止する"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """
+    リクエストごとの相関IDをログとレスポンスヘッダーに付与するASGIミドルウェア
+
+    receiveはそのまま渡すため、ハンドラー側の切断検出（http.disconnect）を妨げない
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+        request_id = headers.get(REQUEST_ID_HEADER.lower())
+        if not request_id:
+            # Cloud RunのトレースヘッダーがあればそのトレースIDを使う
+            request_id = headers.get("x-cloud-trace-context", "").split("/", 1)[0] or new_request_id()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": [*message.get("headers", []), (REQUEST_ID_HEADER.lower().encode("latin-1"), request_id.encode("latin-1"))],
+                }
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# イベントループの遅延を測定する間隔と、ブロッキングとみなす閾値（秒）
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("LOOP_BLOCK_THRESHOLD", "0.25"))
+
+# ヒストグラムのバケット上限（ミリ秒）
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class LoopMonitor:
+    """
+    イベントループの遅延を継続的に測定し、ブロッキングを検出するモニター
+
+    ループ上のタスクが一定間隔でスリープし、予定より遅れて再開した時間を遅延として記録する。
+    別スレッドのウォッチドッグが、ループが閾値以上応答しない間に実行中のスタックを取得する。
+    """
+
+    def __init__(self, interval: float, threshold: float, max_stacks: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self._buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._blocked: deque = deque(maxlen=max_stacks)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """イベントループ上で呼び出して測定を開始する"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self._record(max(0.0, now - started - self.interval))
+
+    def _record(self, lag: float):
+        lag_ms = lag * 1000
+        for i, bound in enumerate(LAG_BUCKETS_MS):
+            if lag_ms <= bound:
+                self._buckets[i] += 1
+                break
+        else:
+            self._buckets[-1] += 1
+        self._count += 1
+        self._sum += lag
+        self._max = max(self._max, lag)
+
+    def _watchdog(self):
+        captured_for = None
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or captured_for == heartbeat:
+                continue
+            # 同じ停止につき1回だけスタックを取得する
+            captured_for = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self._blocked.append({
+                "detected_at": time.time(),
+                "blocked_ms": round(stalled * 1000, 2),
+                "stack": stack,
+            })
+            logger.warning("イベントループが %.0fms ブロックされています:\n%s", stalled * 1000, stack)
+
+    def histogram(self) -> dict:
+        buckets = {f"le_{bound}ms": count for bound, count in zip(LAG_BUCKETS_MS, self._buckets)}
+        buckets["gt_{}ms".format(LAG_BUCKETS_MS[-1])] = self._buckets[-1]
+        return {
+            "count": self._count,
+            "avg_ms": round(self._sum / self._count * 1000, 3) if self._count else 0.0,
+            "max_ms": round(self._max * 1000, 3),
+            "buckets": buckets,
+        }
+
+    def blocked_stacks(self) -> list:
+        return list(self._blocked)
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD)
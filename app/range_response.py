@@ -0,0 +1,108 @@
+import os
+import re
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+
+class FileSliceResponse(Response):
+    """
+    ファイルの一部（または全体）を返す応答
+
+    サーバーがASGIのzerocopysend拡張に対応していればsendfileで送り、
+    対応していなければスレッドプールでチャンクごとに読み込んで送る
+    """
+
+    def __init__(self, path: str, offset: int, length: int, status_code: int, headers: dict, media_type: str):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        super().__init__(
+            status_code=status_code,
+            headers={**headers, "Content-Length": str(length)},
+            media_type=media_type,
+        )
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or self.length == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        # 送信中にファイルが削除されても、開いているディスクリプタからは最後まで読める
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.offset,
+                    "count": self.length,
+                })
+                return
+
+            remaining = self.length
+            await run_in_threadpool(f.seek, self.offset)
+            while remaining > 0:
+                chunk = await run_in_threadpool(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+
+def _parse_range(value: str, size: int) -> Optional[tuple[int, int]]:
+    """単一のRange（bytes=start-end / bytes=start- / bytes=-suffix）を (開始, 長さ) にする。満たせない場合はNone"""
+    match = RANGE_PATTERN.match(value.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    start, end = match.groups()
+    if start == "":
+        length = min(int(end), size)
+        return (size - length, length) if length > 0 else None
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or end < start:
+        return None
+    return start, end - start + 1
+
+
+def file_response(request: Request, path: str, etag: str, media_type: str, cache_control: str) -> Response:
+    """
+    変更されないファイルを条件付きリクエスト・Rangeリクエストに対応して返す
+
+    Args:
+        etag: 強いETag（引用符を含む）
+        cache_control: Cache-Controlヘッダーの値
+
+    Raises:
+        FileNotFoundError: ファイルが存在しない
+    """
+    size = os.stat(path).st_size
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-RangeのETagが一致しない場合はファイル全体を返す
+    if range_header and (not if_range or if_range.strip() == etag):
+        if "," in range_header:
+            # 複数範囲（multipart/byteranges）には対応せず全体を返す
+            return FileSliceResponse(path, 0, size, 200, headers, media_type)
+        byte_range = _parse_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, length = byte_range
+        headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{size}"
+        return FileSliceResponse(path, start, length, 206, headers, media_type)
+
+    return FileSliceResponse(path, 0, size, 200, headers, media_type)
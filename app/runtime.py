@@ -0,0 +1,137 @@
+import importlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Backends:
+    """解決済みのバックエンド関数"""
+    detect_intent_texts: Callable
+    detect_intent_texts_async: Callable
+    transcribe_audio: Callable
+    streaming_recognize: Callable
+    synthesize_speech: Callable
+    source: str
+
+
+@dataclass(frozen=True)
+class RuntimeProfile:
+    """起動時に一度だけ解決する実行環境の情報（ハンドラーからは読み取るだけ）"""
+    is_docker: bool
+    is_cloud_run: bool
+    is_local: bool
+    env_name: str
+    backend_source: str
+    backends_available: bool
+    resolution_ms: float
+
+    def environment(self) -> dict:
+        return {
+            "docker": self.is_docker,
+            "cloud_run": self.is_cloud_run,
+            "local": self.is_local,
+        }
+
+
+def detect_environment() -> tuple[bool, bool, bool]:
+    """実行環境を検出"""
+    is_docker = os.path.exists('/.dockerenv') or os.environ.get('DOCKER_ENV') == 'true'
+    is_cloud_run = os.environ.get('K_SERVICE') is not None
+    is_local = not (is_docker or is_cloud_run)
+    return is_docker, is_cloud_run, is_local
+
+
+def _import_backends(prefix: str) -> Backends:
+    dialogflow_client = importlib.import_module(f"{prefix}dialogflow_client")
+    stt = importlib.import_module(f"{prefix}stt")
+    tts = importlib.import_module(f"{prefix}tts")
+    return Backends(
+        detect_intent_texts=dialogflow_client.detect_intent_texts,
+        detect_intent_texts_async=dialogflow_client.detect_intent_texts_async,
+        transcribe_audio=stt.transcribe_audio,
+        streaming_recognize=stt.streaming_recognize,
+        synthesize_speech=tts.synthesize_speech,
+        source=f"{prefix}*" if prefix else "*",
+    )
+
+
+def _dummy_backends() -> Backends:
+    def dummy_detect_intent_texts(text: str, session_id: str, timeout=None):
+        return [f"エラー: Dialogflowに接続できません。入力: {text}"]
+
+    async def dummy_detect_intent_texts_async(text: str, session_id: str, timeout=None):
+        return dummy_detect_intent_texts(text, session_id)
+
+    def dummy_transcribe_audio(audio_content, filename=None, timeout=None):
+        return "音声認識サービスに接続できません"
+
+    def dummy_streaming_recognize(audio_chunks, filename=None, timeout=None):
+        for _ in audio_chunks:
+            pass
+        yield "音声認識サービスに接続できません", True
+
+    def dummy_synthesize_speech(text, timeout=None):
+        return b"TTS service unavailable"
+
+    return Backends(
+        detect_intent_texts=dummy_detect_intent_texts,
+        detect_intent_texts_async=dummy_detect_intent_texts_async,
+        transcribe_audio=dummy_transcribe_audio,
+        streaming_recognize=dummy_streaming_recognize,
+        synthesize_speech=dummy_synthesize_speech,
+        source="dummy",
+    )
+
+
+def resolve_runtime(package: Optional[str]) -> tuple[RuntimeProfile, Backends]:
+    """
+    実行環境とバックエンドのインポート先を起動時に一度だけ解決する
+
+    Args:
+        package: 呼び出し元のパッケージ名（api_serverの__package__）。
+            ヘルパーモジュールと同じ経路でバックエンドをインポートし、モジュールの二重読み込みを防ぐ
+
+    Returns:
+        (RuntimeProfile, Backends)
+    """
+    started = time.perf_counter()
+    is_docker, is_cloud_run, is_local = detect_environment()
+
+    # 呼び出し元と同じパッケージを最優先し、次に環境に応じた順で試す
+    prefixes = [f"{package}."] if package else [""]
+    for prefix in ([""] if is_docker or is_cloud_run else ["app."]) + ["app.", ""]:
+        if prefix not in prefixes:
+            prefixes.append(prefix)
+
+    backends = None
+    for prefix in prefixes:
+        try:
+            backends = _import_backends(prefix)
+            logger.info("インポート成功 (%s)", backends.source)
+            break
+        except ImportError as e:
+            logger.warning("インポート失敗 (%s*): %s", prefix, e)
+
+    if backends is None:
+        logger.error("すべてのインポート方法が失敗しました。ダミー関数を使用します。")
+        backends = _dummy_backends()
+
+    profile = RuntimeProfile(
+        is_docker=is_docker,
+        is_cloud_run=is_cloud_run,
+        is_local=is_local,
+        env_name="Cloud Run" if is_cloud_run else "Docker" if is_docker else "Local",
+        backend_source=backends.source,
+        backends_available=backends.source != "dummy",
+        resolution_ms=round((time.perf_counter() - started) * 1000, 2),
+    )
+    logger.info(
+        "環境検出: Docker=%s, CloudRun=%s, Local=%s (解決時間 %.2fms)",
+        is_docker, is_cloud_run, is_local, profile.resolution_ms
+    )
+    return profile, backends
@@ -0,0 +1,171 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# stt.py が LongRunningRecognize に切り替えるサイズと同じ閾値
+LONG_AUDIO_THRESHOLD = int(os.environ.get("LONG_AUDIO_THRESHOLD", str(500 * 1024)))
+
+
+class Priority(IntEnum):
+    """バックエンド処理の優先度クラス（値が小さいほど優先）"""
+    INTERACTIVE = 0  # テキストチャット
+    SHORT_VOICE = 1  # 短い音声の認識・応答生成・音声合成
+    LONG_AUDIO = 2   # LongRunningRecognizeを使う長い音声の認識
+
+
+def classify_audio(size: int) -> Priority:
+    """音声ファイルのサイズから音声認識の優先度クラスを決める"""
+    return Priority.LONG_AUDIO if size > LONG_AUDIO_THRESHOLD else Priority.SHORT_VOICE
+
+
+class _Waiter:
+    def __init__(self, priority: Priority, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PriorityScheduler:
+    """
+    依存サービスの実行枠を優先度順に割り当てる（枠数はスレッドプール・隔壁のサイズと揃え、実際に待ちが発生する場所で順序を決める）
+
+    飢餓対策として、待ち時間が aging_seconds 経過するごとに優先度を1段階引き上げ、
+    LONG_AUDIO が同時に使える枠を long_audio_max に制限する。
+    bind_limits() で依存サービスの適応型リミッターの現在の上限を渡すと、枠数をその上限以下に抑える
+    （リミッターで即座に拒否せず、超えた分はここで優先度順に待たせる）。
+    """
+
+    def __init__(self, capacity: int, long_audio_max: int, aging_seconds: float):
+        self.capacity = capacity
+        self.long_audio_max = min(long_audio_max, capacity)
+        self.aging_seconds = aging_seconds
+        self._seq = itertools.count()
+        self._waiters: list[_Waiter] = []
+        self._running = {priority: 0 for priority in Priority}
+        self._granted = {priority: 0 for priority in Priority}
+        self._waits = {priority: deque(maxlen=1000) for priority in Priority}
+        self._limit: Optional[Callable[[], int]] = None
+        self._long_audio_limit: Optional[Callable[[], int]] = None
+
+    def bind_limits(self, limit: Callable[[], int], long_audio_limit: Optional[Callable[[], int]] = None):
+        """
+        依存サービスへの同時呼び出し数の上限を枠の割り当てに反映する
+
+        Args:
+            limit: LONG_AUDIO以外が同時に使える枠数（現在の上限を返す関数）
+            long_audio_limit: LONG_AUDIOが同時に使える枠数（省略時はlimitと共通）
+        """
+        self._limit = limit
+        self._long_audio_limit = long_audio_limit
+
+    def _effective_priority(self, waiter: _Waiter, now: float) -> float:
+        if self.aging_seconds <= 0:
+            return waiter.priority
+        return waiter.priority - (now - waiter.enqueued_at) / self.aging_seconds
+
+    def _can_run(self, priority: Priority) -> bool:
+        if sum(self._running.values()) >= self.capacity:
+            return False
+        long_running = self._running[Priority.LONG_AUDIO]
+        if priority == Priority.LONG_AUDIO:
+            if self._long_audio_limit is not None:
+                return long_running < min(self.long_audio_max, self._long_audio_limit())
+            if self._limit is not None and sum(self._running.values()) >= self._limit():
+                return False
+            return long_running < self.long_audio_max
+        if self._limit is None:
+            return True
+        running = sum(self._running.values())
+        if self._long_audio_limit is not None:
+            # LONG_AUDIOは別のリミッターで数える
+            running -= long_running
+        return running < self._limit()
+
+    def _dispatch(self):
+        """空いている枠を待機中の処理に優先度順で割り当てる"""
+        now = time.monotonic()
+        # キャンセル済みの待機者を除く
+        self._waiters = [w for w in self._waiters if not w.future.done()]
+        while self._waiters:
+            candidates = [w for w in self._waiters if self._can_run(w.priority)]
+            if not candidates:
+                return
+            waiter = min(candidates, key=lambda w: (self._effective_priority(w, now), w.seq))
+            self._waiters.remove(waiter)
+            self._grant(waiter.priority, now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def _grant(self, priority: Priority, wait: float):
+        self._running[priority] += 1
+        self._granted[priority] += 1
+        self._waits[priority].append(wait)
+
+    def _release(self, priority: Priority):
+        self._running[priority] -= 1
+        self._dispatch()
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """待たずに実行枠を取得できれば取得する"""
+        # 実行できる待機者がいれば先に割り当てる。実行できない待機者（上限に達したLONG_AUDIO等）には譲らない
+        self._dispatch()
+        if self._can_run(priority):
+            self._grant(priority, 0.0)
+            return True
+        return False
+
+    async def acquire(self, priority: Priority):
+        """指定した優先度で実行枠を取得する（release()で返却すること）"""
+        if self.try_acquire(priority):
+            return
+        waiter = _Waiter(priority, next(self._seq))
+        self._waiters.append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # 枠が割り当てられた直後にキャンセルされた場合は返却する
+                self._release(priority)
+            raise
+
+    def release(self, priority: Priority):
+        self._release(priority)
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority):
+        """指定した優先度で実行枠を取得する"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        result = {"capacity": self.capacity, "long_audio_max": self.long_audio_max}
+        for priority in Priority:
+            waits = sorted(self._waits[priority])
+            result[priority.name.lower()] = {
+                "running": self._running[priority],
+                "waiting": sum(1 for w in self._waiters if w.priority == priority),
+                "granted": self._granted[priority],
+                "p99_wait_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000, 2) if waits else 0.0,
+            }
+        return result
+
+
+# 待機中の処理の優先度を1段階上げるまでの時間（秒）
+# 隔壁の待機時間の上限（BULKHEAD_QUEUE_TIMEOUT）より十分短くし、待機中にLONG_AUDIOでも最優先まで上がるようにする
+PRIORITY_AGING_SECONDS = float(os.environ.get("PRIORITY_AGING_SECONDS", "0.3"))
+# 長い音声（LongRunningRecognize）の認識が同時に使えるSTTの枠数
+LONG_AUDIO_MAX_CONCURRENCY = int(os.environ.get("LONG_AUDIO_MAX_CONCURRENCY", "4"))
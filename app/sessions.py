@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _SessionEntry:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SessionSequencer:
+    """同一セッションのターンを到着順に直列化し、異なるセッション間は並列に実行する"""
+
+    def __init__(self):
+        self._entries: dict[str, _SessionEntry] = {}
+        self._turns = 0
+        self._serialized = 0
+
+    @asynccontextmanager
+    async def turn(self, session_id: str):
+        """セッションの1ターン分の実行権を取得する"""
+        entry = self._entries.get(session_id)
+        if entry is None:
+            entry = _SessionEntry()
+            self._entries[session_id] = entry
+        entry.users += 1
+        self._turns += 1
+        if entry.lock.locked():
+            # 同じセッションの前のターンが実行中のため完了を待つ
+            self._serialized += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            # 待機中のターンがなければ破棄する（アイドルなセッションを保持しない）
+            if entry.users == 0 and self._entries.get(session_id) is entry:
+                del self._entries[session_id]
+
+    def stats(self) -> dict:
+        return {
+            "active_sessions": len(self._entries),
+            "waiting_turns": sum(entry.users - 1 for entry in self._entries.values() if entry.users > 1),
+            "turns": self._turns,
+            "serialized_turns": self._serialized,
+        }
+
+
+session_sequencer = SessionSequencer()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable, Type
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    同じキーの呼び出しが同時に実行中であれば、1回のRPCとその結果を共有する
+
+    冪等な呼び出し（同じテキストの音声合成など）にのみ使うこと。
+    全ての呼び出し元がキャンセルされた場合は実行中の処理もキャンセルする。
+    共有した呼び出しが先行した呼び出し元のタイムアウト（retry_on）で失敗した場合、
+    後から合流した呼び出し元は結果を引き継がず、自身のfunc（自身の残り時間）でやり直す。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, _Call] = {}
+        self._executed = 0
+        self._shared = 0
+        self._retried = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]],
+                 retry_on: tuple[Type[BaseException], ...] = ()) -> Any:
+        """
+        Args:
+            func: 呼び出し元自身の設定（タイムアウト・優先度）で実行する関数
+            retry_on: 合流先の失敗を引き継がずにやり直す例外（先行した呼び出し元のタイムアウト等）
+        """
+        while True:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call(asyncio.ensure_future(func()))
+                self._calls[key] = call
+                self._executed += 1
+
+                def on_done(task, key=key, call=call):
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+
+                call.task.add_done_callback(on_done)
+            else:
+                self._shared += 1
+
+            call.waiters += 1
+            try:
+                return await asyncio.shield(call.task)
+            except retry_on:
+                if leader:
+                    raise
+                self._retried += 1
+                logger.info("%s: 共有した呼び出しがタイムアウトしたため残り時間でやり直します", self.name)
+            finally:
+                call.waiters -= 1
+                if call.waiters == 0 and not call.task.done():
+                    call.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "executed": self._executed,
+            "shared": self._shared,
+            "retried": self._retried,
+        }
+
+
+stt_flight = SingleFlight("stt")
+tts_flight = SingleFlight("tts")
+
+
+def singleflight_stats() -> dict:
+    return {group.name: group.stats() for group in (stt_flight, tts_flight)}
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import queue
+from typing import Callable, Optional
+
+try:
+    from .executors import run_in_pool
+except ImportError:
+    from executors import run_in_pool
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class RecognizeStream:
+    """
+    WebSocketで受け取った音声チャンクを同期のstreaming_recognizeに渡し、
+    認識結果をイベントループ側で非同期に受け取るためのブリッジ（1発話分）
+    """
+
+    def __init__(self, recognize: Callable, filename: Optional[str] = None, timeout: Optional[float] = None):
+        self._recognize = recognize
+        self._filename = filename
+        self._timeout = timeout
+        self._audio: queue.Queue = queue.Queue()
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._closed = False
+        self._task: Optional[asyncio.Future] = None
+
+    def start(self):
+        """専用プールのスレッドで認識を開始する"""
+        self._task = asyncio.ensure_future(run_in_pool("stt_stream", self._run))
+
+    def feed(self, chunk: bytes):
+        """音声チャンクを送る（終了後は無視する）"""
+        if not self._closed:
+            self._audio.put(chunk)
+
+    def close(self):
+        """発話の終了を伝える（認識側は残りの音声を処理してから確定結果を返す）"""
+        if not self._closed:
+            self._closed = True
+            self._audio.put(_END)
+
+    def _chunks(self):
+        while True:
+            chunk = self._audio.get()
+            if chunk is _END:
+                return
+            yield chunk
+
+    def _publish(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._results.put_nowait, item)
+        except RuntimeError:
+            # イベントループが既に停止している
+            pass
+
+    def _run(self):
+        try:
+            for result in self._recognize(self._chunks(), filename=self._filename, timeout=self._timeout):
+                self._publish(result)
+        except Exception as e:
+            logger.error("ストリーミング音声認識エラー: %s", e)
+            self._publish(e)
+        finally:
+            self._publish(_END)
+
+    async def results(self):
+        """(認識結果, 確定したかどうか) を順に返す"""
+        while True:
+            item = await self._results.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def wait_closed(self):
+        """認識スレッドの終了を待つ"""
+        self.close()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                pass
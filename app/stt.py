@@ -1,10 +1,36 @@
+from google.api_core.exceptions import DeadlineExceeded
 from google.cloud import speech
+import concurrent.futures
+import grpc
 import logging
 import mimetypes
 import os
+from typing import Iterable, Iterator, Optional
+
+try:
+    from .clients import clients
+    from .limiter import LimitExceeded, get_limiter
+    from .bulkhead import bulkheads
+except ImportError:
+    from clients import clients
+    from limiter import LimitExceeded, get_limiter
+    from bulkhead import bulkheads
 
 logger = logging.getLogger(__name__)
-speech_client = speech.SpeechClient()
+def _probe(client, timeout: float):
+    """ウォームアップ時にチャネルの接続（DNS解決・TLSハンドシェイク）を完了させる"""
+    grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=timeout)
+
+# クライアントは初回利用時またはウォームアップ時にプロセスごとに生成する（fork前に生成しない）
+clients.register("speech", speech.SpeechClient, probe=_probe)
+
+# レイテンシとエラー率に応じて同時呼び出し数を調整する（LongRunningRecognizeは別枠）
+# 上限を超えた呼び出しはSTTの隔壁で優先度順に待たせる（初期値は隔壁の枠数）
+_limiter = get_limiter("stt", latency_threshold=5.0, initial_limit=bulkheads["stt"].max_concurrent)
+_long_limiter = get_limiter(
+    "stt_long", latency_threshold=120.0, initial_limit=bulkheads["stt"].scheduler.long_audio_max
+)
+bulkheads["stt"].limit_by(_limiter.current_limit, _long_limiter.current_limit)
 
 def get_audio_config(audio_content: bytes, filename: str = None):
     """音声ファイルの形式に応じて適切な設定を取得"""
@@ -14,7 +40,7 @@ def get_audio_config(audio_content: bytes, filename: str = None):
     if filename:
         mime_type, _ = mimetypes.guess_type(filename)
         ext = os.path.splitext(filename)[1].lower()
-        logger.info(f"ファイル名: {filename}, 拡張子: {ext}, 推測MIMEタイプ: {mime_type}")
+        logger.debug("ファイル名: %s, 拡張子: %s, 推測MIMEタイプ: %s", filename, ext, mime_type)
     
     # デフォルト
     encoding = speech.RecognitionConfig.AudioEncoding.WEBM_OPUS
@@ -24,47 +50,47 @@ def get_audio_config(audio_content: bytes, filename: str = None):
     if ext in [".mp3"]:
         encoding = speech.RecognitionConfig.AudioEncoding.MP3
         sample_rate = 44100
-        logger.info("拡張子でMP3として処理")
+        logger.debug("拡張子でMP3として処理")
     elif ext in [".wav"]:
         encoding = speech.RecognitionConfig.AudioEncoding.LINEAR16
         sample_rate = 16000
-        logger.info("拡張子でWAVとして処理")
+        logger.debug("拡張子でWAVとして処理")
     elif ext in [".ogg"]:
         encoding = speech.RecognitionConfig.AudioEncoding.OGG_OPUS
         sample_rate = 48000
-        logger.info("拡張子でOGGとして処理")
+        logger.debug("拡張子でOGGとして処理")
     elif ext in [".m4a", ".aac"]:
         encoding = speech.RecognitionConfig.AudioEncoding.MP3
         sample_rate = 44100
-        logger.info("拡張子でM4A/AACとして処理（MP3として扱う）")
+        logger.debug("拡張子でM4A/AACとして処理（MP3として扱う）")
     elif ext in [".webm"]:
         encoding = speech.RecognitionConfig.AudioEncoding.WEBM_OPUS
         sample_rate = 48000
-        logger.info("拡張子でWebMとして処理")
+        logger.debug("拡張子でWebMとして処理")
     # MIMEタイプで判定（拡張子で判定できなかった場合）
     elif mime_type:
         if "mpeg" in mime_type or "mp3" in mime_type:
             encoding = speech.RecognitionConfig.AudioEncoding.MP3
             sample_rate = 44100
-            logger.info("MIMEタイプでMP3として処理")
+            logger.debug("MIMEタイプでMP3として処理")
         elif "wav" in mime_type:
             encoding = speech.RecognitionConfig.AudioEncoding.LINEAR16
             sample_rate = 16000
-            logger.info("MIMEタイプでWAVとして処理")
+            logger.debug("MIMEタイプでWAVとして処理")
         elif "ogg" in mime_type:
             encoding = speech.RecognitionConfig.AudioEncoding.OGG_OPUS
             sample_rate = 48000
-            logger.info("MIMEタイプでOGGとして処理")
+            logger.debug("MIMEタイプでOGGとして処理")
         elif "m4a" in mime_type or "aac" in mime_type or "mp4a-latm" in mime_type:
             encoding = speech.RecognitionConfig.AudioEncoding.MP3
             sample_rate = 44100
-            logger.info("MIMEタイプでM4A/AACとして処理（MP3として扱う）")
+            logger.debug("MIMEタイプでM4A/AACとして処理（MP3として扱う）")
         elif "webm" in mime_type:
             encoding = speech.RecognitionConfig.AudioEncoding.WEBM_OPUS
             sample_rate = 48000
-            logger.info("MIMEタイプでWebMとして処理")
+            logger.debug("MIMEタイプでWebMとして処理")
         else:
-            logger.info(f"未知のMIMEタイプ: {mime_type}, デフォルト設定を使用")
+            logger.debug("未知のMIMEタイプ: %s, デフォルト設定を使用", mime_type)
     else:
         # MIMEタイプと拡張子の両方が不明な場合、ファイルの先頭バイトで判定を試行
         if len(audio_content) >= 4:
@@ -72,16 +98,16 @@ def get_audio_config(audio_content: bytes, filename: str = None):
             if audio_content[:4] == b'\x1a\x45\xdf\xa3':
                 encoding = speech.RecognitionConfig.AudioEncoding.WEBM_OPUS
                 sample_rate = 48000
-                logger.info("マジックナンバーでWebMとして処理")
+                logger.debug("マジックナンバーでWebMとして処理")
             # MP3ファイルのマジックナンバーをチェック
             elif audio_content[:3] == b'ID3' or audio_content[:2] == b'\xff\xfb':
                 encoding = speech.RecognitionConfig.AudioEncoding.MP3
                 sample_rate = 44100
-                logger.info("マジックナンバーでMP3として処理")
+                logger.debug("マジックナンバーでMP3として処理")
             else:
-                logger.info("マジックナンバーで判定できませんでした, デフォルト設定を使用")
+                logger.debug("マジックナンバーで判定できませんでした, デフォルト設定を使用")
         else:
-            logger.info("ファイルサイズが小さすぎて判定できませんでした, デフォルト設定を使用")
+            logger.debug("ファイルサイズが小さすぎて判定できませんでした, デフォルト設定を使用")
 
     config = speech.RecognitionConfig(
         encoding=encoding,
@@ -89,29 +115,44 @@ def get_audio_config(audio_content: bytes, filename: str = None):
         sample_rate_hertz=sample_rate,
         enable_automatic_punctuation=True,
     )
-    logger.info(f"最終設定 - エンコーディング: {encoding}, サンプルレート: {sample_rate}")
+    logger.debug("最終設定 - エンコーディング: %s, サンプルレート: %s", encoding, sample_rate)
     return config
 
-def transcribe_audio(audio_content: bytes, filename: str = None) -> str:
+def transcribe_audio(audio_content: bytes, filename: str = None, timeout: Optional[float] = None) -> str:
+    """
+    音声を文字起こしする
+    
+    Args:
+        audio_content: 音声データ
+        filename: ファイル名（形式判定に使用）
+        timeout: RPCのタイムアウト（秒）。Noneの場合はライブラリのデフォルト
+    """
+    # timeout未指定の場合はライブラリのデフォルトを使う
+    rpc_options = {"timeout": timeout} if timeout is not None else {}
     try:
         audio = speech.RecognitionAudio(content=audio_content)
         config = get_audio_config(audio_content, filename)
         
-        logger.info(f"音声認識を開始します... ファイルサイズ: {len(audio_content)} bytes")
+        logger.info("音声認識を開始します... ファイルサイズ: %d bytes", len(audio_content))
 
         # ファイルサイズが小さすぎる場合のチェック
         if len(audio_content) < 1000:  # 1KB未満
-            logger.warning(f"音声ファイルが小さすぎます: {len(audio_content)} bytes")
+            logger.warning("音声ファイルが小さすぎます: %d bytes", len(audio_content))
             return "音声ファイルが小さすぎます。もう少し長く話してください。"
 
         # より長い音声ファイルに対応するため、閾値を500KBに下げる
         if len(audio_content) > 500 * 1024:  # 500KB以上
             logger.info("長い音声ファイルのため、LongRunningRecognizeを使用します")
-            operation = speech_client.long_running_recognize(config=config, audio=audio)
-            # タイムアウト時間を300秒（5分）に延長
-            response = operation.result(timeout=300)
+            with _long_limiter.acquire():
+                operation = clients.get("speech").long_running_recognize(config=config, audio=audio, **rpc_options)
+                # タイムアウト時間を300秒（5分）に延長（締め切りが指定されていればそちらを優先）
+                try:
+                    response = operation.result(timeout=min(timeout, 300) if timeout is not None else 300)
+                except concurrent.futures.TimeoutError:
+                    raise DeadlineExceeded("LongRunningRecognizeが時間内に完了しませんでした")
         else:
-            response = speech_client.recognize(config=config, audio=audio)
+            with _limiter.acquire():
+                response = clients.get("speech").recognize(config=config, audio=audio, **rpc_options)
         
         if not response.results:
             logger.warning("音声認識結果が空でした")
@@ -119,17 +160,21 @@ def transcribe_audio(audio_content: bytes, filename: str = None) -> str:
         
         transcript = response.results[0].alternatives[0].transcript
         confidence = response.results[0].alternatives[0].confidence
-        logger.info(f"音声認識結果: {transcript} (信頼度: {confidence:.2f})")
+        logger.info("音声認識結果: %d文字 (信頼度: %.2f)", len(transcript), confidence)
+        logger.debug("音声認識結果: %s", transcript)
         
         # 信頼度が低すぎる場合の警告
         if confidence < 0.3:
-            logger.warning(f"音声認識の信頼度が低いです: {confidence:.2f}")
+            logger.warning("音声認識の信頼度が低いです: %.2f", confidence)
             return f"音声認識の信頼度が低いです。もう一度はっきりと話してください。認識結果: {transcript}"
         
         return transcript
         
+    except (LimitExceeded, DeadlineExceeded):
+        # タイムアウトは認識結果の文字列にせず呼び出し元に伝え、締め切り超過として扱わせる
+        raise
     except Exception as e:
-        logger.error(f"音声認識エラー: {e}")
+        logger.error("音声認識エラー: %s", e)
         # エラーメッセージに基づいて再試行
         if "MP3 encoding" in str(e) and "webm" in str(e).lower():
             logger.info("WebMファイルをMP3として処理しようとしました。WebM_OPUSで再試行します")
@@ -142,15 +187,18 @@ def transcribe_audio(audio_content: bytes, filename: str = None) -> str:
                     enable_automatic_punctuation=True,
                 )
                 audio = speech.RecognitionAudio(content=audio_content)
-                response = speech_client.recognize(config=config, audio=audio)
+                with _limiter.acquire():
+                    response = clients.get("speech").recognize(config=config, audio=audio, **rpc_options)
                 
                 if response.results:
                     transcript = response.results[0].alternatives[0].transcript
                     confidence = response.results[0].alternatives[0].confidence
-                    logger.info(f"再試行成功 - 音声認識結果: {transcript} (信頼度: {confidence:.2f})")
+                    logger.info("再試行成功 - 音声認識結果: %d文字 (信頼度: %.2f)", len(transcript), confidence)
                     return transcript
+            except (LimitExceeded, DeadlineExceeded):
+                raise
             except Exception as retry_error:
-                logger.error(f"再試行も失敗: {retry_error}")
+                logger.error("再試行も失敗: %s", retry_error)
         
         # より具体的なエラーメッセージ
         if "400" in str(e):
@@ -162,3 +210,35 @@ def transcribe_audio(audio_content: bytes, filename: str = None) -> str:
         else:
             return f"音声認識中にエラーが発生しました: {str(e)}"
 
+
+def streaming_recognize(audio_chunks: Iterable[bytes], filename: str = None, timeout: Optional[float] = None) -> Iterator[tuple[str, bool]]:
+    """
+    話している途中の音声チャンクを逐次認識する（1発話分）
+
+    Args:
+        audio_chunks: 音声チャンクのイテレーター（終端で発話の終了を伝える）
+        filename: 形式判定に使うファイル名（例: audio.webm）
+        timeout: ストリーム全体のタイムアウト（秒）。Noneの場合はライブラリのデフォルト
+
+    Yields:
+        (認識結果, 確定したかどうか)。確定した結果を返した時点で終了する
+    """
+    rpc_options = {"timeout": timeout} if timeout is not None else {}
+    config = speech.StreamingRecognitionConfig(
+        config=get_audio_config(b"", filename),
+        interim_results=True,
+        # 発話の終わりを検出したら確定結果を返してストリームを閉じる
+        single_utterance=True,
+    )
+    requests = (speech.StreamingRecognizeRequest(audio_content=chunk) for chunk in audio_chunks if chunk)
+    responses = clients.get("speech").streaming_recognize(config=config, requests=requests, **rpc_options)
+    for response in responses:
+        for result in response.results:
+            if not result.alternatives:
+                continue
+            transcript = result.alternatives[0].transcript
+            if result.is_final:
+                logger.info("ストリーミング音声認識結果: %d文字 (信頼度: %.2f)", len(transcript), result.alternatives[0].confidence)
+                yield transcript, True
+                return
+            yield transcript, False
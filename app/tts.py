@@ -1,18 +1,42 @@
 from google.cloud import texttospeech
+from typing import Optional
 
-tts_client = texttospeech.TextToSpeechClient()
+try:
+    from .clients import clients
+    from .limiter import get_limiter
+    from .bulkhead import bulkheads
+except ImportError:
+    from clients import clients
+    from limiter import get_limiter
+    from bulkhead import bulkheads
 
-def synthesize_speech(text: str) -> bytes:
+def _probe(client, timeout: float):
+    """ウォームアップ時の疎通確認（音声一覧の取得は課金されない軽量な呼び出し）"""
+    client.list_voices(language_code="ja-JP", timeout=timeout)
+
+# クライアントは初回利用時またはウォームアップ時にプロセスごとに生成する（fork前に生成しない）
+clients.register("tts", texttospeech.TextToSpeechClient, probe=_probe)
+
+# レイテンシとエラー率に応じて同時呼び出し数を調整する
+# 上限を超えた呼び出しは隔壁で優先度順に待たせる（初期値は隔壁の枠数）
+_limiter = get_limiter("tts", latency_threshold=2.0, initial_limit=bulkheads["tts"].max_concurrent)
+bulkheads["tts"].limit_by(_limiter.current_limit)
+
+def synthesize_speech(text: str, timeout: Optional[float] = None) -> bytes:
     input_text = texttospeech.SynthesisInput(text=text)
     voice = texttospeech.VoiceSelectionParams(
         language_code="ja-JP",
         ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
     )
     audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-    response = tts_client.synthesize_speech(
-        input=input_text,
-        voice=voice,
-        audio_config=audio_config
-    )
+    # timeout未指定の場合はライブラリのデフォルトを使う
+    rpc_options = {"timeout": timeout} if timeout is not None else {}
+    with _limiter.acquire():
+        response = clients.get("tts").synthesize_speech(
+            input=input_text,
+            voice=voice,
+            audio_config=audio_config,
+            **rpc_options
+        )
     return response.audio_content
 
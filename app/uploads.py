@@ -0,0 +1,223 @@
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    from .errors import Overloaded, PayloadTooLarge
+    from .ingest import UPLOAD_MAX_BYTES, UPLOAD_RETRY_AFTER, AudioIngest, ingest_budget
+except ImportError:
+    from errors import Overloaded, PayloadTooLarge
+    from ingest import UPLOAD_MAX_BYTES, UPLOAD_RETRY_AFTER, AudioIngest, ingest_budget
+
+logger = logging.getLogger(__name__)
+
+# 再開可能なアップロードの保存先と保持期間（ワーカープロセス間で共有）
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/tmp/uploads")
+UPLOAD_TTL = float(os.environ.get("UPLOAD_TTL", "1800"))
+# 未完了のアップロードの件数と合計バイト数の上限（Cloud Runの/tmpはメモリのため）
+UPLOAD_MAX_OPEN = int(os.environ.get("UPLOAD_MAX_OPEN", "32"))
+UPLOAD_STORE_MAX_BYTES = int(os.environ.get("UPLOAD_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 期限切れのアップロードを削除する間隔（秒）
+UPLOAD_PURGE_INTERVAL = 60
+
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class UploadConflict(Exception):
+    """チャンクのオフセットが現在の受信済みバイト数と一致しない、または同じアップロードに同時に書き込んでいる"""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+class UploadStore:
+    """
+    再開可能なアップロードのチャンクをローカルファイルに追記するストア
+
+    受信済みのバイト数（オフセット）はファイルサイズそのもので、途中で切断された場合も
+    書き込めた分までを保持する。同じアップロードへの書き込みはファイルロックで直列化する。
+    未完了のアップロードの件数（max_open）と合計バイト数（max_total_bytes）を超える場合はOverloadedとする
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_open: int, max_total_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.max_total_bytes = max_total_bytes
+        self._last_purge = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, upload_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}.{suffix}")
+
+    def data_path(self, upload_id: str) -> str:
+        return self._path(upload_id, "part")
+
+    def usage(self) -> tuple[int, int]:
+        """未完了のアップロードの (件数, 合計バイト数)"""
+        count = total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".part"):
+                continue
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+        return count, total
+
+    def _reject(self, reason: str):
+        logger.warning("アップロードを拒否しました (%s)", reason)
+        raise Overloaded(f"アップロードが混雑しています。しばらくしてから再試行してください。({reason})", UPLOAD_RETRY_AFTER)
+
+    def create(self, filename: Optional[str], length: Optional[int]) -> dict:
+        """
+        アップロードを作成する
+
+        Args:
+            filename: 元のファイル名（形式判定に使用）
+            length: 全体のバイト数（分かっていれば）
+
+        Raises:
+            PayloadTooLarge: 全体のバイト数が上限を超える
+            Overloaded: 未完了のアップロードの件数・合計バイト数が上限に達している
+        """
+        if length is not None and length > self.max_bytes:
+            raise PayloadTooLarge(f"音声ファイルが大きすぎます（上限 {self.max_bytes} bytes）")
+        self.purge_expired()
+        count, total = self.usage()
+        if count >= self.max_open:
+            self._reject("未完了のアップロードが多すぎます")
+        if total + (length or 0) > self.max_total_bytes:
+            self._reject("未完了のアップロードの合計サイズが上限に達しています")
+
+        upload_id = str(uuid.uuid4())
+        upload = {"upload_id": upload_id, "filename": filename, "length": length, "created_at": time.time()}
+        open(self.data_path(upload_id), "wb").close()
+        with open(self._path(upload_id, "json"), "w", encoding="utf-8") as f:
+            json.dump(upload, f, ensure_ascii=False)
+        return {**upload, "offset": 0}
+
+    def get(self, upload_id: str) -> Optional[dict]:
+        """アップロードの情報と現在のオフセット（存在しない場合はNone）"""
+        try:
+            # パス操作を防ぐためUUID形式のIDのみ受け付ける
+            upload_id = str(uuid.UUID(upload_id))
+        except ValueError:
+            return None
+        try:
+            with open(self._path(upload_id, "json"), encoding="utf-8") as f:
+                upload = json.load(f)
+            upload["offset"] = os.path.getsize(self.data_path(upload_id))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return upload
+
+    @contextmanager
+    def writer(self, upload: dict, offset: int):
+        """
+        指定したオフセットからチャンクを追記するファイルを開く
+
+        Raises:
+            UploadConflict: オフセットが一致しない、または別のリクエストが書き込み中
+        """
+        with open(self.data_path(upload["upload_id"]), "ab") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict("同じアップロードに別のチャンクを書き込み中です", upload["offset"])
+            try:
+                current = os.fstat(f.fileno()).st_size
+                if offset != current:
+                    raise UploadConflict(f"Upload-Offsetが一致しません（受信済み {current} bytes）", current)
+                yield _ChunkWriter(self, f, current, upload.get("length"))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def ingest(self, upload: dict) -> AudioIngest:
+        """
+        受信済みのデータを取り込む（直接アップロードと同じ形式判定・長さの上限を適用する）
+
+        Raises:
+            PayloadTooLarge: 長さが上限を超えた
+            Overloaded: 取り込み中のアップロードの合計が予算を超える
+        """
+        reserved = ingest_budget.reserve(min(upload["offset"], self.max_bytes))
+        ingest = AudioIngest(upload.get("filename"), reserved_bytes=reserved)
+        try:
+            with open(self.data_path(upload["upload_id"]), "rb") as f:
+                while True:
+                    chunk = f.read(READ_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    ingest.feed(chunk)
+        except BaseException:
+            ingest.close()
+            raise
+        return ingest
+
+    def delete(self, upload_id: str):
+        for suffix in ("part", "json"):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def purge_expired(self):
+        """保持期間を過ぎた（完了しなかった）アップロードを削除する（作成時と定期的に呼び出す）"""
+        now = time.time()
+        if now - self._last_purge < UPLOAD_PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        cutoff = now - UPLOAD_TTL
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".part"):
+                continue
+            try:
+                # 最後にチャンクを受信した時刻で判定する
+                if os.path.getmtime(os.path.join(self.directory, name)) < cutoff:
+                    self.delete(name[:-len(".part")])
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        if removed:
+            logger.info("期限切れのアップロードを %d 件削除しました", removed)
+
+
+class _ChunkWriter:
+    """1リクエスト分のチャンクの書き込み（上限を超えた時点で打ち切る）"""
+
+    def __init__(self, store: UploadStore, f, offset: int, length: Optional[int]):
+        self._store = store
+        self._file = f
+        self.offset = offset
+        self._limit = min(length, store.max_bytes) if length is not None else store.max_bytes
+        self._declared = length is not None
+        self._store_room: Optional[int] = None
+
+    def write(self, chunk: bytes):
+        """チャンクを書き込む（スレッドプールから呼び出す）"""
+        if self.offset + len(chunk) > self._limit:
+            if self._declared:
+                raise UploadConflict("Upload-Lengthを超えるデータを受信しました", self.offset)
+            raise PayloadTooLarge(f"音声ファイルが大きすぎます（上限 {self._limit} bytes）")
+        if self._store_room is None:
+            # 他のアップロードの分を含めた合計の空き（このリクエストの最初の書き込みで確認する）
+            self._store_room = self._store.max_total_bytes - self._store.usage()[1]
+        if len(chunk) > self._store_room:
+            self._store._reject("未完了のアップロードの合計サイズが上限に達しています")
+        self._store_room -= len(chunk)
+        self._file.write(chunk)
+        # 切断された場合も書き込めた分までを受信済みとして残す
+        self._file.flush()
+        self.offset += len(chunk)
+
+
+upload_store = UploadStore(UPLOAD_DIR, UPLOAD_MAX_BYTES, UPLOAD_MAX_OPEN, UPLOAD_STORE_MAX_BYTES)
@@ -0,0 +1,134 @@
+import base64
+import json
+import uuid
+from typing import Optional
+from urllib.parse import quote
+
+from starlette.responses import JSONResponse, Response
+
+# /voice_chat の応答形式（Acceptヘッダーで選択する）
+JSON = "json"
+AUDIO = "audio"
+MULTIPART = "multipart"
+
+AUDIO_MEDIA_TYPE = "audio/mpeg"
+MULTIPART_MEDIA_TYPE = "multipart/mixed"
+
+# 音声を本文で返す場合にテキストを載せるヘッダー（非ASCIIを含むためURLエンコードする）
+TRANSCRIPT_HEADER = "X-Transcript"
+RESPONSE_HEADER = "X-Response-Text"
+SESSION_HEADER = "X-Session-Id"
+AUDIO_STATUS_HEADER = "X-Audio-Status"
+AUDIO_URL_HEADER = "X-Audio-Url"
+
+EXPOSE_HEADERS = [TRANSCRIPT_HEADER, RESPONSE_HEADER, SESSION_HEADER, AUDIO_STATUS_HEADER, AUDIO_URL_HEADER]
+
+
+JSON_MEDIA_TYPE = "application/json"
+
+# 応答形式ごとのメディアタイプと、q値が同じ場合の優先順（明示された形式の中では音声を含む形式を優先する）
+_MEDIA_TYPES = {MULTIPART: MULTIPART_MEDIA_TYPE, AUDIO: AUDIO_MEDIA_TYPE, JSON: JSON_MEDIA_TYPE}
+_PREFERENCE = {MULTIPART: 2, AUDIO: 1, JSON: 0}
+
+
+def _parse_accept(accept: str) -> list[tuple[str, float]]:
+    """Acceptヘッダーを (メディアレンジ, q値) のリストにする（q値が不正な範囲は除く）"""
+    ranges = []
+    for part in accept.split(","):
+        media_range, *params = [item.strip() for item in part.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = -1.0
+        if 0.0 <= q <= 1.0:
+            ranges.append((media_range.lower(), q))
+    return ranges
+
+
+def _quality(media_type: str, ranges: list[tuple[str, float]]) -> tuple[float, bool]:
+    """メディアタイプのq値（最も具体的に一致する範囲の値）と、明示されているか"""
+    main_type = media_type.split("/", 1)[0]
+    for candidate, explicit in ((media_type, True), (f"{main_type}/*", False), ("*/*", False)):
+        matched = [q for media_range, q in ranges if media_range == candidate]
+        if matched:
+            return max(matched), explicit
+    return 0.0, False
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """
+    Acceptヘッダーから応答形式を選ぶ（q値が最も高い形式。q=0の形式は選ばない）
+
+    audio/mpeg → 音声をバイナリで返し、テキストはヘッダーに載せる
+    multipart/mixed → JSONと音声の2パートで返す
+    application/json（*/* 等のワイルドカードのみの場合・受け入れ可能な形式がない場合も） → 従来どおりbase64の音声を含むJSON
+    """
+    ranges = _parse_accept(accept or "")
+    best, best_key = JSON, None
+    for mode, media_type in _MEDIA_TYPES.items():
+        q, explicit = _quality(media_type, ranges)
+        if q <= 0.0:
+            continue
+        # q値が同じ場合は明示された形式を優先し、ワイルドカードのみで一致した形式の中ではJSONを選ぶ
+        key = (q, explicit, _PREFERENCE[mode] if explicit else -_PREFERENCE[mode])
+        if best_key is None or key > best_key:
+            best, best_key = mode, key
+    return best
+
+
+def render(
+    mode: str,
+    transcript: str,
+    response_text: str,
+    session_id: str,
+    audio: Optional[bytes],
+    audio_url: Optional[str] = None,
+    inline_audio: bool = True,
+) -> Response:
+    """
+    音声チャットの結果を指定された形式の応答にする
+
+    Args:
+        mode: negotiate() の戻り値
+        audio: 合成した音声（スキップした場合はNone）
+        audio_url: 音声ストアに保存した音声のURL（/audio/{id}）
+        inline_audio: JSON形式でbase64の音声を含めるか（Falseの場合はURLのみ）
+    """
+    fields = {"transcript": transcript, "response": response_text, "session_id": session_id, "audio_url": audio_url}
+
+    if mode == AUDIO:
+        headers = {
+            TRANSCRIPT_HEADER: quote(transcript),
+            RESPONSE_HEADER: quote(response_text),
+            SESSION_HEADER: session_id,
+            AUDIO_STATUS_HEADER: "ok" if audio is not None else "skipped",
+        }
+        if audio_url:
+            headers[AUDIO_URL_HEADER] = audio_url
+        if audio is None:
+            # 音声を合成できなかった場合はテキスト（ヘッダー）のみ
+            return Response(status_code=204, headers=headers)
+        return Response(content=audio, media_type=AUDIO_MEDIA_TYPE, headers=headers)
+
+    if mode == MULTIPART:
+        boundary = uuid.uuid4().hex
+        parts = [
+            b"Content-Type: application/json; charset=utf-8\r\n\r\n"
+            + json.dumps({**fields, "audio": audio is not None}, ensure_ascii=False).encode("utf-8")
+        ]
+        if audio is not None:
+            parts.append(f"Content-Type: {AUDIO_MEDIA_TYPE}\r\n\r\n".encode("ascii") + audio)
+        delimiter = f"--{boundary}\r\n".encode("ascii")
+        body = b"".join(delimiter + part + b"\r\n" for part in parts) + f"--{boundary}--\r\n".encode("ascii")
+        return Response(content=body, media_type=f"{MULTIPART_MEDIA_TYPE}; boundary={boundary}")
+
+    return JSONResponse(content={
+        **fields,
+        "audio_base64": base64.b64encode(audio).decode("utf-8") if audio is not None and inline_audio else None,
+    })
@@ -1,5 +1,5 @@
 import { useState, useCallback } from 'react';
-import { Message, ApiResponse, VoiceResponse } from '../types/chat';
+import { Message, ApiResponse, VoiceStreamEvent } from '../types/chat';
 
 // 環境に応じたAPI URLを取得する関数
 const getApiUrl = (): string => {
@@ -130,52 +130,70 @@ export const useChat = () => {
       const apiUrl = getApiUrl();
       console.log('Using API URL for voice:', apiUrl);
 
-      const response = await fetch(`${apiUrl}/voice_chat`, {
+      // ステージごとのイベント（NDJSON）を受け取り、届いた時点で表示する
+      const response = await fetch(`${apiUrl}/voice_chat/stream`, {
         method: 'POST',
         body: formData,
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         const errorText = await response.text();
         console.error('音声認識APIエラー:', errorText);
         throw new Error(`音声認識に失敗しました: ${response.status} ${errorText}`);
       }
 
-      const data: VoiceResponse = await response.json();
-      
-      // エラーレスポンスのチェック
-      if (data.error) {
-        throw new Error(data.error);
-      }
-      
-      if (data.transcript) {
-        // 音声認識結果をユーザーメッセージとして表示
-        const userMessage: Message = {
-          id: Date.now().toString(),
-          content: `🎤 ${data.transcript}`,
-          role: 'user',
-          timestamp: new Date(),
-        };
-        setMessages((prev: Message[]) => [...prev, userMessage]);
-
-        // エージェントの応答を表示
-        if (data.response) {
-          const cleanResponse = extractResponseContent(data.response);
-          const assistantMessage: Message = {
-            id: (Date.now() + 1).toString(),
-            content: cleanResponse,
-            role: 'assistant',
-            timestamp: new Date(),
-          };
-          setMessages((prev: Message[]) => [...prev, assistantMessage]);
+      const handleEvent = (event: VoiceStreamEvent) => {
+        switch (event.type) {
+          case 'transcript':
+            if (event.transcript) {
+              // 音声認識結果をユーザーメッセージとして表示
+              const userMessage: Message = {
+                id: Date.now().toString(),
+                content: `🎤 ${event.transcript}`,
+                role: 'user',
+                timestamp: new Date(),
+              };
+              setMessages((prev: Message[]) => [...prev, userMessage]);
+            }
+            break;
+          case 'response':
+            if (event.response) {
+              // エージェントの応答を表示
+              const assistantMessage: Message = {
+                id: (Date.now() + 1).toString(),
+                content: extractResponseContent(event.response),
+                role: 'assistant',
+                timestamp: new Date(),
+              };
+              setMessages((prev: Message[]) => [...prev, assistantMessage]);
+            }
+            // セッションIDを更新
+            if (event.session_id) {
+              setSessionId(event.session_id);
+            }
+            break;
+          case 'error':
+            throw new Error(event.error || '音声を認識できませんでした');
         }
-        
-        // セッションIDを更新
-        if (data.session_id) {
-          setSessionId(data.session_id);
+      };
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop() ?? '';
+        for (const line of lines) {
+          if (line.trim()) {
+            handleEvent(JSON.parse(line));
+          }
         }
-      } else {
-        throw new Error('音声を認識できませんでした');
+      }
+      if (buffer.trim()) {
+        handleEvent(JSON.parse(buffer));
       }
     } catch (error) {
       console.error('Voice chat error:', error);
@@ -21,4 +21,16 @@ export interface VoiceResponse {
   response?: string;
   session_id?: string;
   error?: string;
-} 
\ No newline at end of file
+} 
+export interface VoiceStreamEvent {
+  type: 'accepted' | 'transcript' | 'response' | 'audio' | 'audio_skipped' | 'done' | 'error';
+  transcript?: string;
+  response?: string;
+  session_id?: string;
+  index?: number;
+  text?: string;
+  audio_base64?: string;
+  last?: boolean;
+  reason?: string;
+  error?: string;
+}
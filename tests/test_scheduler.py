@@ -0,0 +1,83 @@
+import asyncio
+
+from app.scheduler import Priority, PriorityScheduler
+
+
+def test_grants_in_priority_order():
+    async def run():
+        scheduler = PriorityScheduler(capacity=1, long_audio_max=1, aging_seconds=0)
+        order = []
+
+        async def job(priority, tag):
+            async with scheduler.slot(priority):
+                order.append(tag)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(
+            job(Priority.SHORT_VOICE, "first"),
+            job(Priority.LONG_AUDIO, "long"),
+            job(Priority.SHORT_VOICE, "short"),
+            job(Priority.INTERACTIVE, "text"),
+        )
+        return order
+
+    assert asyncio.run(run()) == ["first", "text", "short", "long"]
+
+
+def test_capped_long_audio_waiter_does_not_block_other_classes():
+    async def run():
+        scheduler = PriorityScheduler(capacity=8, long_audio_max=4, aging_seconds=0)
+        for _ in range(4):
+            assert scheduler.try_acquire(Priority.LONG_AUDIO)
+        # 上限に達したLONG_AUDIOは待機する
+        waiter = asyncio.ensure_future(scheduler.acquire(Priority.LONG_AUDIO))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        # 実行できない待機者がいても空いている枠は使える
+        assert scheduler.try_acquire(Priority.SHORT_VOICE)
+        await asyncio.wait_for(scheduler.acquire(Priority.INTERACTIVE), 0.1)
+
+        scheduler.release(Priority.LONG_AUDIO)
+        await asyncio.wait_for(waiter, 0.1)
+
+    asyncio.run(run())
+
+
+def test_waiter_is_granted_when_enqueued_with_free_capacity():
+    async def run():
+        scheduler = PriorityScheduler(capacity=2, long_audio_max=2, aging_seconds=0)
+        limit = {"value": 1}
+        scheduler.bind_limits(lambda: limit["value"])
+        assert scheduler.try_acquire(Priority.SHORT_VOICE)
+        waiter = asyncio.ensure_future(scheduler.acquire(Priority.SHORT_VOICE))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        # 上限が広がった後に届いた処理は、先に待っている処理に枠を譲る
+        limit["value"] = 2
+        assert not scheduler.try_acquire(Priority.SHORT_VOICE)
+        await asyncio.wait_for(waiter, 0.1)
+
+    asyncio.run(run())
+
+
+def test_aging_promotes_long_waiter_past_fresh_higher_class():
+    async def run():
+        scheduler = PriorityScheduler(capacity=1, long_audio_max=1, aging_seconds=0.01)
+        order = []
+        assert scheduler.try_acquire(Priority.SHORT_VOICE)
+
+        async def job(priority, tag):
+            async with scheduler.slot(priority):
+                order.append(tag)
+
+        long_job = asyncio.ensure_future(job(Priority.LONG_AUDIO, "long"))
+        await asyncio.sleep(0.05)
+        text_job = asyncio.ensure_future(job(Priority.INTERACTIVE, "text"))
+        await asyncio.sleep(0)
+        scheduler.release(Priority.SHORT_VOICE)
+        await asyncio.gather(long_job, text_job)
+        return order
+
+    assert asyncio.run(run()) == ["long", "text"]